@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+#
+# band_change.py
+#
+# Copyright (C) 2020 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+Band change across the WSPRLite, the LPF and the tuner.
+
+The three stages are independent so they are started together and the
+station is ready in the time of the slowest one rather than the sum.
+Each stage is timed and the result is reported when all have finished.
+
+The device stage goes through the NetIFClient command queue like any other
+command, so a newer band change replaces one still waiting to be sent.
+
+If a stage fails:
+    device  --  the LPF and tuner are put back to the band the device is
+                still on so the hardware matches the frequency, unless the
+                change was superseded by a newer one
+    lpf     --  the filter in circuit is not known so TX is stopped
+    tuner   --  reported only, the tuner can be retuned by hand
+"""
+
+# All imports
+from imports import *
+
+# Application imports
+sys.path.append('..')
+from common.defs import *
+import webrelay
+import tuner
+from command_queue import SUPERSEDED
+
+# Stages
+DEVICE = 'device'
+LPF = 'lpf'
+TUNER = 'tuner'
+
+#========================================================================
+# Band change pipeline
+class BandChange(object):
+
+    #----------------------------------------------
+    # Constructor
+    def __init__(self, net, lpf_pool, tuner_pool, tunerapi = None):
+        """
+        Constructor
+
+        Arguments:
+            net         --  NetIFClient
+            lpf_pool    --  executor for LPF switching
+            tuner_pool  --  executor for tuner switching
+            tunerapi    --  tuner API or None if there is no tuner
+
+        """
+
+        self.__net = net
+        self.__lpf_pool = lpf_pool
+        self.__tuner_pool = tuner_pool
+        self.__tunerapi = tunerapi
+        # Band the device was last set to, see set_band()
+        self.__band = None
+
+    #----------------------------------------------
+    # Band the device is on
+    def set_band(self, band):
+        """
+        Record the band the device is on, read from the device frequency
+        so failover has a band to go back to before the first change
+
+        Arguments:
+            band    --  band in metres
+        """
+
+        self.__band = band
+
+    #----------------------------------------------
+    # Change band
+    def change(self, band, request = None, with_lpf = True, with_tuner = True):
+        """
+        Start a band change
+
+        Arguments:
+            band        --  band in metres
+            request     --  device request, default (SET_BAND, band)
+            with_lpf    --  switch the LPF
+            with_tuner  --  switch the tuner
+
+        Returns a Future completed with a report
+            {'band', 'success', 'stages' : {stage : (success, message, seconds)},
+             'total' : seconds, 'action' : failover taken or ''}
+        """
+
+        if request == None:
+            request = (SET_BAND, band)
+        start = monotonic()
+        device = Future()
+        self.__net.post(request[0], request[1] if len(request) > 1 else None, device)
+        stages = {DEVICE : device}
+        if with_lpf:
+            stages[LPF] = self.__lpf_pool.submit(webrelay.set_lpf, WEBRELAY_IP, WEBRELAY_PORT, band)
+        if with_tuner and self.__tunerapi != None:
+            stages[TUNER] = self.__tuner_pool.submit(tuner.set_tuner, self.__tunerapi, band)
+
+        report = {'band' : band, 'stages' : {}}
+        result = Future()
+        lock = threading.Lock()
+
+        def done(stage, f):
+            # Called on whichever thread completed the stage
+            try:
+                r = f.result()
+                if r == None:
+                    r = (True, '')
+            except Exception as e:
+                r = (False, str(e))
+            with lock:
+                report['stages'][stage] = (r[0], r[1], monotonic() - start)
+                if len(report['stages']) < len(stages):
+                    return
+            report['total'] = monotonic() - start
+            report['success'] = all(s[0] for s in report['stages'].values())
+            report['action'] = self.__failover(band, report['stages'])
+            result.set_result(report)
+
+        for stage, f in stages.items():
+            f.add_done_callback(lambda f, stage = stage: done(stage, f))
+        return result
+
+    #----------------------------------------------
+    # Recover from failed stages, returns the action taken
+    def __failover(self, band, stages):
+        if stages[DEVICE][0]:
+            self.__band = band
+        actions = []
+        if not stages[DEVICE][0] and stages[DEVICE][1] != SUPERSEDED and self.__band != None and self.__band != band:
+            # Put the hardware back to the band the device is on
+            if LPF in stages:
+                self.__lpf_pool.submit(webrelay.set_lpf, WEBRELAY_IP, WEBRELAY_PORT, self.__band)
+            if TUNER in stages:
+                self.__tuner_pool.submit(tuner.set_tuner, self.__tunerapi, self.__band)
+            actions.append('hardware restored to %dm' % self.__band)
+        if LPF in stages and not stages[LPF][0]:
+            # Never transmit into an unknown filter
+            self.__net.post(SET_IDLE)
+            actions.append('TX stopped')
+        return ', '.join(actions)
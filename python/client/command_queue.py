@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+#
+# command_queue.py
+#
+# Copyright (C) 2019 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+Bounded queue of commands waiting to be sent to the server.
+
+While the server is slow or unreachable the UI keeps posting commands.
+Rather than build a backlog that is served long after it is stale:
+
+    A read that is already waiting is not queued again.
+    A frequency change replaces any frequency change still waiting, only
+    the newest SET_FREQ or SET_BAND is sent.
+    Other commands are queued in order up to the queue size, after which
+    put() refuses them.
+
+So the queue never holds more than one of each read, one frequency change
+and the bounded number of other commands.
+
+A command can carry a Future for its reply. Merged reads share the reply,
+a replaced frequency change gets (False, SUPERSEDED) and a refused
+command (False, 'Queue full!').
+"""
+
+# Python imports
+import os, sys
+import threading
+from collections import deque
+
+# Application imports
+sys.path.append('..')
+from common.defs import *
+
+# Reads that can be merged with one already waiting
+READS = (GET_CALLSIGN, GET_LOCATOR, GET_FREQ, GET_STATUS)
+# Commands where only the newest matters, all share one slot
+LATEST = (SET_FREQ, SET_BAND)
+# Reply reason for a frequency change replaced by a newer one
+SUPERSEDED = 'Superseded!'
+
+#========================================================================
+# Coalescing command queue
+class CommandQueue(object):
+
+    #----------------------------------------------
+    # Constructor
+    def __init__(self, size = CLIENT_QUEUE_SIZE):
+        """
+        Constructor
+
+        Arguments:
+            size    --  maximum number of commands other than merged reads
+                        and frequency changes
+
+        """
+
+        self.__size = size
+        # Entries in order [cmd, args, time posted, futures for the reply]
+        self.__q = deque()
+        # Key : entry for commands that are merged
+        self.__waiting = {}
+        # Number of commands in the bounded part
+        self.__count = 0
+        self.__woken = False
+        self.__cond = threading.Condition()
+
+        self.__stats = {'queued' : 0, 'merged' : 0, 'replaced' : 0, 'refused' : 0}
+
+    #----------------------------------------------
+    # Add a command
+    def put(self, cmd, args, posted, future = None):
+        """
+        Queue a command, may be called from any thread
+
+        Arguments:
+            cmd     --  request type
+            args    --  request argument or None
+            posted  --  time posted
+            future  --  Future for the reply or None
+
+        Returns False if the queue is full and the command was refused
+        """
+
+        futures = [] if future == None else [future]
+        superseded = []
+        queued = False
+        with self.__cond:
+            key = LATEST if cmd in LATEST else cmd
+            entry = self.__waiting.get(key)
+            if entry != None:
+                if cmd in LATEST:
+                    # Newest value wins, keep the place in the queue
+                    entry[0] = cmd
+                    entry[1] = args
+                    superseded = entry[3]
+                    entry[3] = futures
+                    self.__stats['replaced'] += 1
+                else:
+                    entry[3].extend(futures)
+                    self.__stats['merged'] += 1
+            elif cmd in READS or cmd in LATEST:
+                entry = [cmd, args, posted, futures]
+                self.__waiting[key] = entry
+                queued = True
+            elif self.__count >= self.__size:
+                self.__stats['refused'] += 1
+                entry = None
+            else:
+                entry = [cmd, args, posted, futures]
+                self.__count += 1
+                queued = True
+            if queued:
+                self.__q.append(entry)
+                self.__stats['queued'] += 1
+                self.__cond.notify()
+        # Complete outside the lock, callbacks may post again
+        for f in superseded:
+            f.set_result((False, SUPERSEDED))
+        if entry == None:
+            for f in futures:
+                f.set_result((False, 'Queue full!'))
+            return False
+        return True
+
+    #----------------------------------------------
+    # Take the next command
+    def get(self, timeout):
+        """
+        Wait for a command
+
+        Arguments:
+            timeout --  seconds to wait
+
+        Returns (cmd, args, time posted, futures) or None on timeout or wake()
+        """
+
+        with self.__cond:
+            if len(self.__q) == 0 and not self.__woken:
+                self.__cond.wait(timeout)
+            self.__woken = False
+            if len(self.__q) == 0:
+                return None
+            entry = self.__q.popleft()
+            cmd = entry[0]
+            key = LATEST if cmd in LATEST else cmd
+            if self.__waiting.get(key) is entry:
+                del self.__waiting[key]
+            else:
+                self.__count -= 1
+            return tuple(entry)
+
+    #----------------------------------------------
+    # Wake a waiting get()
+    def wake(self):
+        with self.__cond:
+            self.__woken = True
+            self.__cond.notify()
+
+    #----------------------------------------------
+    # Number of commands waiting
+    def __len__(self):
+        return len(self.__q)
+
+    #----------------------------------------------
+    # Copy of the statistics
+    def stats(self):
+        with self.__cond:
+            return dict(self.__stats)
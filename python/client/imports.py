@@ -32,14 +32,16 @@ import urllib.request
 import pickle
 from collections import deque
 import time
-from time import sleep
+from time import sleep, monotonic
 import threading
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor
 import pprint
 pp = pprint.PrettyPrinter(indent=1)
 
 #=====================================================
 # Lib imports
-from PyQt5.QtCore import Qt, QCoreApplication, QTimer, QObject, QRect, QEvent, QMargins
+from PyQt5.QtCore import Qt, pyqtSignal, QCoreApplication, QTimer, QObject, QRect, QEvent, QMargins
 from PyQt5.QtGui import QPalette, QColor, QFont, QIcon, QPainter, QPixmap, QPen
 from PyQt5.QtWidgets import QApplication, qApp
 from PyQt5.QtWidgets import QWidget, QToolTip, QStyle, QStatusBar, QMainWindow, QDialog, QAction, QMessageBox, QInputDialog, QDialogButtonBox, QGroupBox
@@ -29,12 +29,38 @@ from imports import *
 # Application imports
 sys.path.append('..')
 from common.defs import *
+from common import wire
+from command_queue import CommandQueue
 
 """
 Client Interface to the WSPRLite server application:
 
 Commands are UDP:
     
+Requests use the binary protocol in common/wire.py. Each request carries
+an id which the server echoes. Requests are pipelined, up to
+CLIENT_MAX_IN_FLIGHT are outstanding at once and a receive thread routes
+each response to its request by id. A request that is not answered within
+CLIENT_REQUEST_TIMEOUT fails on its own without holding up the others and
+a late response to it is discarded. The datagram size is negotiated with
+HELLO before the first request.
+
+The client subscribes to SUBSCRIBE_TOPICS and renews the subscription
+well inside the lease. Changes pushed by the server arrive with request
+id 0 in the same form as the response to the GET request, so they go to
+the callback like any other response.
+
+A client talks to one device on the server, set by the device id. Pushed
+changes from other devices are ignored.
+
+Commands are posted with post() and the thread blocks on the queue until
+one arrives so each command is sent as soon as it is posted. The queue is
+bounded and merges duplicate commands, see command_queue.py. While
+CLIENT_MAX_IN_FLIGHT requests are outstanding the thread waits to send and
+commands stay in the queue where they can still be merged. The time from
+post() to the datagram being sent is recorded, see get_latency(). A
+caller that needs the reply passes a Future to post(), it is completed with
+the response data as the callback is.
 """
 
 #========================================================================
@@ -43,22 +69,25 @@ class NetIFClient(threading.Thread):
     
     #----------------------------------------------
     # Constructor
-    def __init__(self, q, callback):
+    def __init__(self, callback, device = 0):
         """
         Constructor
         
         Arguments:
-            q           --  queue on which requests are posted
             callback    --  callback here when data arrives
+            device      --  id of the device on the server
             
         """
 
         super(NetIFClient, self).__init__()
         self.__callback = callback
-        self.__q = q
+        self.__device = device
+        # Commands posted as (cmd, args, time posted, futures)
+        self.__q = CommandQueue()
         
         self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.__sock.settimeout(3)
+        # Short timeout so the receive thread can expire requests
+        self.__sock.settimeout(0.1)
         
         self.__address = (SERVER_IP, SERVER_PORT)
         self.__terminate = False
@@ -75,6 +104,18 @@ class NetIFClient(threading.Thread):
         }
         
         self.__lock = threading.Lock()
+        # Limits the requests outstanding
+        self.__in_flight = threading.BoundedSemaphore(CLIENT_MAX_IN_FLIGHT)
+        
+        # Request id, 1-65535, 0 is reserved for unsolicited messages
+        self.__rid = 0
+        # Outstanding requests, rid : [future, deadline]
+        self.__pending = {}
+        
+        self.__receiver = threading.Thread(target=self.__receive_loop)
+        
+        # Command to wire latency
+        self.__latency = {'count' : 0, 'last' : 0.0, 'total' : 0.0, 'max' : 0.0}
     
     #----------------------------------------------
     # Terminate
@@ -82,20 +123,97 @@ class NetIFClient(threading.Thread):
         """ Terminate thread """
         
         self.__terminate = True
+        # Wake the thread
+        self.__q.wake()
+    
+    #----------------------------------------------
+    # Post a command
+    def post(self, cmd, args = None, future = None):
+        """
+        Queue a command, may be called from any thread
+        
+        Arguments:
+            cmd     --  request type
+            args    --  request argument or None
+            future  --  Future completed with the response data or the
+                        failure tuple (False, 'reason'), or None
+        
+        Returns False if the queue is full and the command was dropped
+        """
+        
+        return self.__q.put(cmd, args, monotonic(), future)
+    
+    #----------------------------------------------
+    # Latency statistics
+    def get_latency(self):
+        """
+            Returns (count, last, mean, max) seconds from post() to send
+        """
+        l = self.__latency
+        mean = 0.0
+        if l['count'] > 0:
+            mean = l['total']/l['count']
+        return (l['count'], l['last'], mean, l['max'])
+    
+    #----------------------------------------------
+    # Send a request
+    def request(self, msg):
+        """
+        Send a request, may be called from any thread
+        
+        Arguments:
+            msg     --  (type, value, ...)
+        
+        Returns a Future completed with the response data or the
+        failure tuple (False, 'reason')
+        """
+        
+        self.__in_flight.acquire()
+        future = Future()
+        future.add_done_callback(lambda f: self.__in_flight.release())
+        with self.__lock:
+            # Skip ids still outstanding after a wrap
+            while True:
+                self.__rid = self.__rid % 0xffff + 1
+                if self.__rid not in self.__pending:
+                    break
+            rid = self.__rid
+            self.__pending[rid] = [future, monotonic() + CLIENT_REQUEST_TIMEOUT]
+        try:
+            self.__sock.sendto(wire.encode(rid, msg, self.__device), self.__address)
+        except (OSError, wire.WireError) as e:
+            self.__complete(rid, (False, 'Send failed [%s]' % str(e)))
+        return future
     
     #-------------------------------------------------
     # Thread entry point    
     def run(self):
         """ Listen for events """
+        
+        self.__receiver.start()
+        # Negotiate the datagram size before anything else is sent
+        r = self.request((HELLO, WIRE_MAX_DATAGRAM)).result()
+        if not r[0]:
+            print('WSPRLite Automation - HELLO failed: %s' % r[1])
 
         # Processing loop
+        renew = 0
         while not self.__terminate:
-            while len(self.__q) > 0:
-                cmd, args = self.__q.popleft()
-                self.__dispatch[cmd](args)
-            sleep(0.1)
-            
-        print ("WSPRLite Automation - Net thread exiting...")
+            if monotonic() >= renew:
+                # Renewals double as a keep alive
+                self.__data_exchange((SUBSCRIBE, SUBSCRIBE_TOPICS))
+                renew = monotonic() + SUBSCRIBE_LEASE/3
+            item = self.__q.get(max(0, renew - monotonic()))
+            if item == None:
+                continue
+            cmd, args, posted, futures = item
+            future = self.__dispatch[cmd](args)
+            self.__record_latency(monotonic() - posted)
+            for f in futures:
+                future.add_done_callback(lambda r, f=f: f.set_result(r.result()))
+        
+        self.__receiver.join()
+        print ("WSPRLite Automation - Net thread exiting... command latency (count, last, mean, max) ", self.get_latency(), self.__q.stats())
         
     #=========================================================================
     # Command Execution
@@ -105,51 +223,31 @@ class NetIFClient(threading.Thread):
     # Get callsign
     def __get_callsign(self, p):
         """ Return the configured callsign """
-        r, data = self.__data_exchange((GET_CALLSIGN,), self.__address)
-        if r:
-            self.__callback((GET_CALLSIGN, data))
-        else:
-            self.__callback((GET_CALLSIGN, (False, '')))
+        return self.__data_exchange((GET_CALLSIGN,))
     
     #----------------------------------------------
     # Get locator
     def __get_locator(self, p):
         """ Return the configured locator """
-        r, data = self.__data_exchange((GET_LOCATOR,), self.__address)
-        if r:
-            self.__callback((GET_LOCATOR, data))
-        else:
-            self.__callback((GET_LOCATOR, (False, '')))
+        return self.__data_exchange((GET_LOCATOR,))
             
     #----------------------------------------------
     # Get actual TX frequency
     def __get_freq(self, p):
         """ Return the actual TX frequency in the selected band """
-        r, data = self.__data_exchange((GET_FREQ,), self.__address)
-        if r:
-            self.__callback((GET_FREQ, data))
-        else:
-            self.__callback((GET_FREQ, (False, '')))
+        return self.__data_exchange((GET_FREQ,))
             
     #----------------------------------------------
     # Set TX frequency
     def __set_freq(self, freq):
         """ Sets the TX frequency """
-        r, data = self.__data_exchange((SET_FREQ, freq), self.__address)
-        if r:
-            self.__callback((SET_FREQ, data))
-        else:
-            self.__callback((SET_FREQ, (False, '')))
+        return self.__data_exchange((SET_FREQ, freq))
             
     #----------------------------------------------
     # Set band
     def __set_band(self, band):
         """ Select the band for transmission """
-        r, data = self.__data_exchange((SET_BAND, band), self.__address)
-        if r:
-            self.__callback((SET_BAND, data))
-        else:
-            self.__callback((SET_BAND, (False, '')))
+        return self.__data_exchange((SET_BAND, band))
 
     #----------------------------------------------
     # These are async messages in that the server will wait for the appropriate time
@@ -160,48 +258,90 @@ class NetIFClient(threading.Thread):
     # Set TX mode
     def __set_tx(self, p):
         """ Set device to tx mode """
-        r, data = self.__data_exchange((SET_TX,), self.__address)
-        if r:
-            self.__callback((SET_TX, data))
-        else:
-            self.__callback((SET_TX, (False, '')))
+        return self.__data_exchange((SET_TX,))
         
     #----------------------------------------------
     # Set idle
     def __set_idle(self, p):
         """ Effectively turn TX off after the next TX cycle """
-        r, data = self.__data_exchange((SET_IDLE,), self.__address)
-        if r:
-            self.__callback((SET_IDLE, data))
-        else:
-            self.__callback((SET_IDLE, (False, '')))
+        return self.__data_exchange((SET_IDLE,))
     
     #----------------------------------------------
     # Get status
     def __get_status(self, p):
-        r, data = self.__data_exchange((GET_STATUS,), self.__address)
-        if r:
-            self.__callback((GET_STATUS, data))
-        else:
-            self.__callback((GET_STATUS, (False, '')))
+        return self.__data_exchange((GET_STATUS,))
             
     #----------------------------------------------
     # Send to device
-    def __data_exchange(self, msg, address):
-        """ Send the given message over UDP """
-        self.__lock.acquire()
-        pickledData = pickle.dumps(msg)
-        try:
-            self.__sock.sendto(pickledData, address)
-            rawdata, addr = self.__sock.recvfrom(100)
-            data = pickle.loads(rawdata)
-            if data[0] != msg[0]:
-                print("Data Exchange - expected: %s, got: %s" % (msg[0], data[0]))
-            self.__lock.release()
-            return (True, data[1])
-        except socket.timeout:
-            self.__lock.release()
-            return (False, "Timeout on read!")
+    def __data_exchange(self, msg):
+        """ Send the given message, the callback is made when the response arrives """
+        future = self.request(msg)
+        future.add_done_callback(lambda f: self.__callback((msg[0], f.result())))
+        return future
+    
+    #----------------------------------------------
+    # Record the time a command waited to be sent
+    def __record_latency(self, latency):
+        l = self.__latency
+        l['count'] += 1
+        l['last'] = latency
+        l['total'] += latency
+        l['max'] = max(l['max'], latency)
+    
+    #=========================================================================
+    # Response routing
+    #=========================================================================
+    
+    #----------------------------------------------
+    # Receive thread
+    def __receive_loop(self):
+        while not self.__terminate:
+            try:
+                rawdata, addr = self.__sock.recvfrom(WIRE_MAX_DATAGRAM)
+            except socket.timeout:
+                self.__expire()
+                continue
+            except OSError:
+                # Nothing sent yet or the server is unreachable
+                sleep(0.1)
+                self.__expire()
+                continue
+            try:
+                rid, device, data = wire.decode(rawdata)
+            except wire.WireError as e:
+                print("Data Exchange - bad response: %s" % str(e))
+                continue
+            if rid == 0:
+                # Unsolicited
+                if device == self.__device:
+                    self.__callback(data)
+            elif not self.__complete(rid, data[1]):
+                print("Data Exchange - late or unknown response: %s, %d" % (data[0], rid))
+            self.__expire()
+        # Fail anything still outstanding
+        with self.__lock:
+            rids = list(self.__pending)
+        for rid in rids:
+            self.__complete(rid, (False, 'Terminated!'))
+    
+    #----------------------------------------------
+    # Complete a request, returns False if not outstanding
+    def __complete(self, rid, result):
+        with self.__lock:
+            entry = self.__pending.pop(rid, None)
+        if entry == None:
+            return False
+        entry[0].set_result(result)
+        return True
+    
+    #----------------------------------------------
+    # Fail requests past their deadline
+    def __expire(self):
+        now = monotonic()
+        with self.__lock:
+            rids = [rid for rid, entry in self.__pending.items() if entry[1] <= now]
+        for rid in rids:
+            self.__complete(rid, (False, "Timeout on read!"))
         
 '''        
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
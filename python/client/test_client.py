@@ -23,54 +23,35 @@
 
 # Exercise the application over the UDP interface.
 
+import os, sys
 import socket
-from defs import *
-import pickle
 from time import sleep
 
+sys.path.append('..')
+from common.defs import *
+from common import wire
+
 address = ('192.168.1.114', 10001)
 
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
-pickledData = pickle.dumps((GET_CALLSIGN,))
-sock.sendto(pickledData, address)
-data, sender = sock.recvfrom(100)
-print(pickle.loads(data))
-
-pickledData = pickle.dumps((GET_LOCATOR,))
-sock.sendto(pickledData, address)
-data, sender = sock.recvfrom(100)
-print(pickle.loads(data))
-
-pickledData = pickle.dumps((GET_FREQ,))
-sock.sendto(pickledData, address)
-data, sender = sock.recvfrom(100)
-print(pickle.loads(data))
-
-pickledData = pickle.dumps((SET_TX,))
-sock.sendto(pickledData, address)
-resp = sock.recvfrom(100)
-if resp == None:
-    while True:
-        resp = sock.recvfrom(100)
-        if resp != None:
-            break
-        else:
-            print("Waiting response to SET_TX...")
-            sleep(10)    
-print(pickle.loads(resp[0]))
+rid = 0
+def exchange(msg, device = 0):
+    global rid
+    rid += 1
+    sock.sendto(wire.encode(rid, msg, device), address)
+    data, sender = sock.recvfrom(WIRE_MAX_DATAGRAM)
+    print(wire.decode(data))
+
+exchange((HELLO, WIRE_MAX_DATAGRAM))
+exchange((GET_DEVICES,))
+exchange((GET_STATUS,), ALL_DEVICES)
+exchange((GET_METRICS, 'wsprlite_serial'))
+exchange((GET_CALLSIGN,))
+exchange((GET_LOCATOR,))
+exchange((GET_FREQ,))
+exchange((SET_TX,))
 
 sleep(3)
 
-pickledData = pickle.dumps((SET_IDLE,))
-sock.sendto(pickledData, address)
-resp = sock.recvfrom(100)
-if resp == None:
-    while True:
-        resp = sock.recvfrom(100)
-        if resp != None:
-            break
-        else:
-            print("Waiting response to SET_IDLE...")
-            sleep(10)    
-print(pickle.loads(resp[0]))
\ No newline at end of file
+exchange((SET_IDLE,))
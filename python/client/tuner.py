@@ -26,6 +26,10 @@
 # All imports
 from imports import *
 
+# Application imports
+sys.path.append('..')
+from common.defs import *
+
 #-------------------------------------------------
 # Band to channel number
 band_lookup = {
@@ -37,9 +41,27 @@ band_lookup = {
     10 : 8
 }
 
+#-------------------------------------------------
+# Last memory selected for each tuner
+# tuner : (memory index, time selected)
+# Selecting the same memory again within TUNER_CACHE_MAX_AGE seconds does
+# nothing, the first selection after that is sent to the tuner.
+selected = {}
+
 #-------------------------------------------------
 # Set the tuner for the given band
 def set_tuner(tuner, band):
     index = band_lookup[band]
+    last = selected.get(tuner)
+    if last != None and last[0] == index and monotonic() - last[1] < TUNER_CACHE_MAX_AGE:
+        return
+    # Not known until the tuner accepts it
+    selected.pop(tuner, None)
     tuner.set_memory(index)
+    selected[tuner] = (index, monotonic())
+
+#-------------------------------------------------
+# Forget the memory selected, the next set_tuner() always sends
+def invalidate(tuner):
+    selected.pop(tuner, None)
     
\ No newline at end of file
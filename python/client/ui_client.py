@@ -31,6 +31,7 @@ from common.freq_table import *
 import netif_client as netif
 import webrelay
 import tuner
+import band_change
 
 # Attempt to import the tuner API
 DISABLE_TUNER = False
@@ -43,9 +44,22 @@ except ImportError:
 
 """
 UI for the WSPRLite client application.
+
+LPF and tuner switching can take as long as the HTTP timeout so it is run
+on worker threads, one per device so changes are applied in order. The
+result comes back to the GUI thread as the hwStatus signal and is shown
+in the status bar.
+
+A band or frequency change sets the device, LPF and tuner together, see
+band_change.py. The report comes back as the bandStatus signal.
 """
 class UIClient(QMainWindow):
     
+    # Hardware switching done (device, band, success, message)
+    hwStatus = pyqtSignal(str, int, bool, str)
+    # Band change done (report)
+    bandStatus = pyqtSignal(object)
+    
     def __init__(self, qt_app):
         """
         Constructor
@@ -74,22 +88,32 @@ class UIClient(QMainWindow):
         palette.setColor(QPalette.Background,QColor(124,124,124,255))
         self.setPalette(palette)
         
-        # Create the net interface and a q to dispatch to
-        self.__netq = deque()
-        self.__net = netif.NetIFClient(self.__netq, self.__netCallback)
+        # Workers for hardware switching
+        self.__lpfPool = ThreadPoolExecutor(max_workers=1)
+        self.__tunerPool = ThreadPoolExecutor(max_workers=1)
+        self.hwStatus.connect(self.__hwStatus)
+        self.bandStatus.connect(self.__bandStatus)
+        
+        # Create the net interface
+        self.__net = netif.NetIFClient(self.__netCallback)
         self.__net.start()
         
         # Create the tuner interface
+        self.__tunerapi = None
         if not DISABLE_TUNER:
             self.__tunerapi = tunerlib.Tuner_API('../tuner_lib/auto_tuner.cfg')
+        
+        # Band changes across device, LPF and tuner
+        self.__bandChange = band_change.BandChange(self.__net, self.__lpfPool, self.__tunerPool, self.__tunerapi)
             
         # Initialise the GUI
         self.initUI()
         
         # Init fields
-        self.__netq.append((GET_CALLSIGN, None))
-        self.__netq.append((GET_LOCATOR, None))
-        self.__netq.append((GET_FREQ, None))
+        self.__net.post(GET_CALLSIGN)
+        self.__net.post(GET_LOCATOR)
+        self.__net.post(GET_FREQ)
+        self.__net.post(GET_STATUS)
         
         # Show the GUI
         self.show()
@@ -116,7 +140,10 @@ class UIClient(QMainWindow):
         self.bmessage.setStyleSheet("color: red; font: 14px")
         self.btime = QLabel("")
         self.btime.setStyleSheet("color: blue; font: 14px")
+        self.bhw = QLabel("")
+        self.bhw.setStyleSheet("color: green; font: 14px")
         self.statusBar.addWidget(self.bmessage)
+        self.statusBar.addWidget(self.bhw)
         self.statusBar.addPermanentWidget(self.btime)
         
         # Set layout
@@ -226,6 +253,8 @@ class UIClient(QMainWindow):
     def terminate(self, ):
         self.__net.terminate()
         self.__net.join()
+        self.__lpfPool.shutdown(wait=False)
+        self.__tunerPool.shutdown(wait=False)
         
     # =====================================================================
     # UI Events
@@ -252,27 +281,12 @@ class UIClient(QMainWindow):
         else:
             upper, lower, band = result
             if str(band) in BANDS_AVAILABLE:
-                # Set lite
-                self.__netq.append((SET_FREQ, f))
                 # Set the band in drop down but dont send else freq will be reset
                 index = self.wband.findText(str(band), Qt.MatchFixedString)
                 if index >= 0:
                     self.wband.setCurrentIndex(index)
-                    # Set LPF filter
-                    if self.__lpf:
-                        r = webrelay.set_lpf(WEBRELAY_IP, WEBRELAY_PORT, band)
-                        if not r[0]:
-                            msg = QMessageBox()
-                            msg.setIcon(QMessageBox.Information)
-                            msg.setText("LPF Failure!")
-                            msg.setInformativeText("Failed to select LPF filter.")
-                            msg.setWindowTitle("Info")
-                            msg.setDetailedText(r[1])
-                            msg.setStandardButtons(QMessageBox.Ok)
-                            retval = msg.exec_()
-                    # Set tuner
-                    if self.__tuner:
-                        tuner.set_tuner(self.__tunerapi, band)
+                # Set lite, LPF filter and tuner
+                self.__changeBand(band, (SET_FREQ, f), index >= 0)
             else:
                 msg = QMessageBox()
                 msg.setIcon(QMessageBox.Information)
@@ -287,34 +301,24 @@ class UIClient(QMainWindow):
     # Band change
     def __band(self, ):
         band = int(self.wband.currentText())
-        self.__netq.append((SET_BAND, band))
-        # Set LPF filter
-        if self.__lpf:
-            r = webrelay.set_lpf(WEBRELAY_IP, WEBRELAY_PORT, band)
-            if not r[0]:
-                msg = QMessageBox()
-                msg.setIcon(QMessageBox.Information)
-                msg.setText("LPF Failure!")
-                msg.setInformativeText("Failed to select LPF filter.")
-                msg.setWindowTitle("Info")
-                msg.setDetailedText(r[1])
-                msg.setStandardButtons(QMessageBox.Ok)
-                retval = msg.exec_()
-        # Set tuner
-        if self.__tuner:
-            tuner.set_tuner(self.__tunerapi, band)
+        # Set lite, LPF filter and tuner
+        self.__changeBand(band)
     
     # ------------------------------------------------------
     # TX Control
     def __run(self, ):
         if self.btx.isChecked():
-            self.__netq.append((SET_TX, None))
+            cmd = SET_TX
             self.btx.setText("Stop")
             self.btx.setStyleSheet("color: red; font: 14px")
         else:
-            self.__netq.append((SET_IDLE, None))
+            cmd = SET_IDLE
             self.btx.setText("Start")
             self.btx.setStyleSheet("color: green; font: 14px")
+        if not self.__net.post(cmd):
+            # Too many commands waiting for the server
+            self.bmessage.setText("Busy, command dropped!")
+            self.bmessage.setStyleSheet("color: red; font: 14px")
     
     # ------------------------------------------------------
     # LPF change
@@ -346,9 +350,9 @@ class UIClient(QMainWindow):
         if self.__lastState != self.__connected:
             if self.__connected:
                 # Get info
-                self.__netq.append((GET_CALLSIGN, None))
-                self.__netq.append((GET_LOCATOR, None))
-                self.__netq.append((GET_FREQ, None))
+                self.__net.post(GET_CALLSIGN)
+                self.__net.post(GET_LOCATOR)
+                self.__net.post(GET_FREQ)
                 # Set info
                 self.wcallsign.setText(self.__liteCallsign)
                 self.wlocator.setText(self.__liteLocator)
@@ -365,16 +369,7 @@ class UIClient(QMainWindow):
                             self.wband.setCurrentIndex(index)
                             # Set LPF filter
                             if self.__lpf:
-                                r = webrelay.set_lpf(WEBRELAY_IP, WEBRELAY_PORT, band)
-                                if not r[0]:
-                                    msg = QMessageBox()
-                                    msg.setIcon(QMessageBox.Information)
-                                    msg.setText("LPF Failure!")
-                                    msg.setInformativeText("Failed to select LPF filter.")
-                                    msg.setWindowTitle("Info")
-                                    msg.setDetailedText(r[1])
-                                    msg.setStandardButtons(QMessageBox.Ok)
-                                    retval = msg.exec_()
+                                self.__actuate(self.__lpfPool, 'LPF', band, webrelay.set_lpf, WEBRELAY_IP, WEBRELAY_PORT, band)
                 # Enable buttons
                 self.bfreqset.setEnabled(True)
                 self.bbandset.setEnabled(True)
@@ -384,9 +379,9 @@ class UIClient(QMainWindow):
                 self.bmessage.setStyleSheet("color: green; font: 14px")
             else:
                 # Try again
-                self.__netq.append((GET_CALLSIGN, None))
-                self.__netq.append((GET_LOCATOR, None))
-                self.__netq.append((GET_FREQ, None))
+                self.__net.post(GET_CALLSIGN)
+                self.__net.post(GET_LOCATOR)
+                self.__net.post(GET_FREQ)
                 # Disable buttons
                 self.bfreqset.setEnabled(False)
                 self.bbandset.setEnabled(False)
@@ -412,8 +407,7 @@ class UIClient(QMainWindow):
             print("Error, invalid frequency: ", self.__liteFreq)
             success = False
         if success:
-            # Update TX status
-            self.__netq.append((GET_STATUS, None))
+            # Update TX status, changes are pushed by the server
             self.ltxstate.setText(self.__txstatus)
             if self.__txstatus == IDLE:
                 self.ltxstate.setStyleSheet("color: rgb(27,86,35); font: 14px")
@@ -425,6 +419,61 @@ class UIClient(QMainWindow):
         # Set next tick
         QTimer.singleShot(IDLE_TICKER, self.__idleProcessing)
         
+    # =====================================================================
+    # Hardware switching
+    
+    # ------------------------------------------------------
+    # Change the device band and select LPF and tuner memory if enabled
+    def __changeBand(self, band, request = None, hardware = True):
+        self.bhw.setText("%dm ..." % band)
+        self.bhw.setStyleSheet("color: blue; font: 14px")
+        future = self.__bandChange.change(band, request, hardware and self.__lpf, hardware and self.__tuner)
+        # The signal is delivered on the GUI thread
+        future.add_done_callback(lambda f: self.bandStatus.emit(f.result()))
+    
+    # ------------------------------------------------------
+    # Band change done, on the GUI thread
+    def __bandStatus(self, report):
+        timings = ', '.join('%s %.2fs' % (stage, r[2]) for stage, r in report['stages'].items())
+        print("Band change %dm: %s, total %.2fs" % (report['band'], timings, report['total']))
+        if report['success']:
+            self.bhw.setText("%dm ready in %.2fs" % (report['band'], report['total']))
+            self.bhw.setStyleSheet("color: green; font: 14px")
+        else:
+            failed = ', '.join('%s %s' % (stage, r[1]) for stage, r in report['stages'].items() if not r[0])
+            text = "%dm failed: %s" % (report['band'], failed)
+            if len(report['action']) > 0:
+                text += " (%s)" % report['action']
+            self.bhw.setText(text)
+            self.bhw.setStyleSheet("color: red; font: 14px")
+    
+    # ------------------------------------------------------
+    # Run a switching function on a worker, the result is signalled
+    def __actuate(self, pool, device, band, fn, *args):
+        self.bhw.setText("%s %dm ..." % (device, band))
+        self.bhw.setStyleSheet("color: blue; font: 14px")
+        
+        def done(f):
+            # Worker thread, the signal is delivered on the GUI thread
+            try:
+                r = f.result()
+                if r == None:
+                    r = (True, '')
+            except Exception as e:
+                r = (False, str(e))
+            self.hwStatus.emit(device, band, r[0], r[1])
+        pool.submit(fn, *args).add_done_callback(done)
+    
+    # ------------------------------------------------------
+    # Switching done, on the GUI thread
+    def __hwStatus(self, device, band, success, message):
+        if success:
+            self.bhw.setText("%s %dm" % (device, band))
+            self.bhw.setStyleSheet("color: green; font: 14px")
+        else:
+            self.bhw.setText("%s %dm failed: %s" % (device, band, message))
+            self.bhw.setStyleSheet("color: red; font: 14px")
+    
     # =====================================================================
     # Callbacks
     
@@ -443,10 +492,12 @@ class UIClient(QMainWindow):
                             self.__liteCallsign = result
                         elif cmd == GET_LOCATOR:
                             self.__liteLocator = result
-                        elif cmd == GET_FREQ:
-                            self.__liteFreq = str(result)
-                        elif cmd == SET_BAND:
+                        elif cmd == GET_FREQ or cmd == SET_BAND:
                             self.__liteFreq = str(result)
+                            # So band change failover knows the band the device is on
+                            band = find_band_hz(result)
+                            if band != None:
+                                self.__bandChange.set_band(band)
                         elif cmd == GET_STATUS:
                             self.__txstatus = result
                     else:
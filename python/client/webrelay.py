@@ -26,6 +26,10 @@
 # All imports
 from imports import *
 
+# Application imports
+sys.path.append('..')
+from common.defs import *
+
 #-------------------------------------------------
 # Band to channel number
 band_lookup = {
@@ -37,19 +41,15 @@ band_lookup = {
     10 : 5
 }
 
+# Relay clients by (ip, port), one persistent connection each
+relays = {}
+relays_lock = threading.Lock()
+
 #-------------------------------------------------
 # Set the channel for the given band, first resetting all channels
 # such that only the target LPF is selected.
 def set_lpf(ip, port, band):
-    on_ch = band_lookup[band]
-    # Turn all channels off first
-    for ch in range(6):
-        r = set_web_relays(ip, port, ch, 'off')
-        if not r[0]:
-            return(r)
-    # Set the target channel
-    r = set_web_relays(ip, port, on_ch, 'on')
-    return r
+    return get_relay(ip, port).set_lpf(band)
 
 #-------------------------------------------------
 # This uses the webrelay_min.py Cherrypy server.
@@ -57,9 +57,258 @@ def set_lpf(ip, port, band):
 # For the full interface use webrelay.py and a browser client.
 # Note that the minimal web relay app requires channels to be zero based
 def set_web_relays(ip, port, relay, state):
-    try:
-        urllib.request.urlopen('http://%s:%d/set_channel?relay=%d;state=%s' % (ip, port, relay, state))
-    except Exception as e:
-       return (False, str(e))
-    return (True, '')
-    
\ No newline at end of file
+    return get_relay(ip, port).set_relays(((relay, state),))
+
+#-------------------------------------------------
+# Return the relay client for the given address
+def get_relay(ip, port):
+    with relays_lock:
+        relay = relays.get((ip, port))
+        if relay == None:
+            relay = WebRelay(ip, port)
+            relays[(ip, port)] = relay
+        return relay
+
+#========================================================================
+# Relay client
+#
+# Requests are made over one keep-alive HTTP/1.1 connection which is
+# opened on first use and reopened if the server closes it.
+# An LPF selection is one set_relay_mask request. If the server does not
+# support it the per-channel requests are pipelined, all are written
+# together and the responses read back, so either way the selection
+# costs one round trip.
+#
+# The last mask the server confirmed is kept. Selecting it again sends
+# nothing and per-channel requests are only sent for channels that change.
+# The relay server cannot be read back, so the mask is only trusted for
+# max_age seconds. The first selection after that sends the whole mask in
+# case the relays were changed by something else. Nothing is sent while
+# no selection is made.
+class WebRelay(object):
+    
+    #----------------------------------------------
+    # Constructor
+    def __init__(self, ip, port, timeout = WEBRELAY_TIMEOUT, max_age = WEBRELAY_CACHE_MAX_AGE):
+        """
+        Constructor
+        
+        Arguments:
+            ip      --  relay server address
+            port    --  relay server port
+            timeout --  seconds to wait to connect or for a response
+            max_age --  seconds a confirmed mask is trusted
+            
+        """
+        
+        self.__address = (ip, port)
+        self.__timeout = timeout
+        self.__sock = None
+        self.__file = None
+        # None until the server has been asked, then True if it supports set_relay_mask
+        self.__mask_supported = None
+        # One exchange at a time on the connection
+        self.__lock = threading.Lock()
+        
+        # Last mask confirmed by the server or None if not known
+        self.__mask = None
+        self.__confirmed = 0.0
+        self.__max_age = max_age
+        self.__stats = {'sent' : 0, 'skipped' : 0}
+    
+    #----------------------------------------------
+    # Select the LPF for a band
+    def set_lpf(self, band):
+        """ Turn on the channel for band, all others off """
+        
+        if band not in band_lookup:
+            return (False, 'No LPF for band %s!' % str(band))
+        return self.set_mask(1 << band_lookup[band])
+    
+    #----------------------------------------------
+    # Set all channels
+    def set_mask(self, mask):
+        """
+        Set all relays in one operation
+        
+        Arguments:
+            mask    --  bit n set turns channel n on
+        
+        """
+        
+        known = self.__known()
+        if mask == known:
+            self.__stats['skipped'] += 1
+            return (True, '')
+        self.__stats['sent'] += 1
+        if self.__mask_supported != False:
+            r = self.__exchange(['/set_relay_mask?mask=%d' % mask])
+            if not r[0]:
+                return r
+            status = r[1][0]
+            if status == 200:
+                self.__mask_supported = True
+                self.__confirm(mask)
+                return (True, '')
+            if self.__mask_supported == True or status != 404:
+                self.__mask = None
+                return (False, 'Relay server returned %d' % status)
+            # Older server, use per-channel requests from now on
+            self.__mask_supported = False
+        # Only the channels that change, all if the state is not known
+        changed = (1 << len(band_lookup)) - 1 if known == None else mask ^ known
+        # Off before on so two filters are never selected together
+        relays = [(ch, 'off') for ch in range(len(band_lookup)) if changed & (1 << ch) and not mask & (1 << ch)]
+        relays += [(ch, 'on') for ch in range(len(band_lookup)) if changed & (1 << ch) and mask & (1 << ch)]
+        r = self.set_relays(relays)
+        if r[0] and known == None:
+            self.__confirm(mask)
+        return r
+    
+    #----------------------------------------------
+    # Set individual channels
+    def set_relays(self, relays):
+        """
+        Set channels with per-channel requests sent together
+        
+        Arguments:
+            relays  --  sequence of (channel, 'on' | 'off')
+        
+        """
+        
+        r = self.__exchange(['/set_channel?relay=%d;state=%s' % (ch, state) for ch, state in relays])
+        if not r[0]:
+            self.__mask = None
+            return r
+        for status in r[1]:
+            if status != 200:
+                self.__mask = None
+                return (False, 'Relay server returned %d' % status)
+        if self.__mask != None:
+            # Track the change but leave the time, only a whole mask confirms it
+            for ch, state in relays:
+                if state == 'on':
+                    self.__mask |= 1 << ch
+                else:
+                    self.__mask &= ~(1 << ch)
+        return (True, '')
+    
+    #----------------------------------------------
+    # Forget the relay state, the next selection is sent in full
+    def invalidate(self):
+        self.__mask = None
+    
+    #----------------------------------------------
+    # Copy of the statistics
+    def stats(self):
+        return dict(self.__stats)
+    
+    #----------------------------------------------
+    # Close the connection
+    def close(self):
+        with self.__lock:
+            self.__close()
+    
+    #----------------------------------------------
+    # Confirmed mask if younger than max_age, else None
+    def __known(self):
+        if self.__mask != None and monotonic() - self.__confirmed < self.__max_age:
+            return self.__mask
+        return None
+    
+    #----------------------------------------------
+    # Record a mask confirmed by the server
+    def __confirm(self, mask):
+        self.__mask = mask
+        self.__confirmed = monotonic()
+    
+    #----------------------------------------------
+    # Send requests and read the responses
+    # Returns (True, [status, ...]) or (False, reason)
+    def __exchange(self, paths):
+        with self.__lock:
+            statuses = []
+            todo = list(paths)
+            while len(todo) > 0:
+                # A kept connection may have been closed by the server, if so
+                # the requests not answered are sent again on a new connection
+                fresh = self.__sock == None
+                try:
+                    if fresh:
+                        self.__connect()
+                    self.__sock.sendall(b''.join(self.__request(path) for path in todo))
+                    close = False
+                    while len(todo) > 0 and not close:
+                        status, close = self.__read_response()
+                        statuses.append(status)
+                        todo.pop(0)
+                    if close:
+                        self.__close()
+                except (OSError, ValueError, IndexError) as e:
+                    self.__close()
+                    if fresh:
+                        return (False, str(e))
+            return (True, statuses)
+    
+    #----------------------------------------------
+    # Request bytes for a path
+    def __request(self, path):
+        return ('GET %s HTTP/1.1\r\nHost: %s:%d\r\n\r\n' % (path, self.__address[0], self.__address[1])).encode('ascii')
+    
+    #----------------------------------------------
+    # Open the connection
+    def __connect(self):
+        self.__sock = socket.create_connection(self.__address, self.__timeout)
+        self.__sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.__file = self.__sock.makefile('rb')
+    
+    #----------------------------------------------
+    # Close the connection
+    def __close(self):
+        if self.__sock != None:
+            self.__file.close()
+            self.__sock.close()
+        self.__sock = None
+        self.__file = None
+    
+    #----------------------------------------------
+    # Read one response
+    # Returns (status, True if the server will close the connection)
+    def __read_response(self):
+        f = self.__file
+        line = f.readline()
+        if len(line) == 0:
+            raise ConnectionError('Relay server closed the connection')
+        status = int(line.split()[1])
+        length = None
+        chunked = False
+        close = line.startswith(b'HTTP/1.0')
+        while True:
+            line = f.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, sep, value = line.decode('latin-1').partition(':')
+            name = name.strip().lower()
+            value = value.strip().lower()
+            if name == 'content-length':
+                length = int(value)
+            elif name == 'transfer-encoding':
+                chunked = value == 'chunked'
+            elif name == 'connection':
+                close = value == 'close'
+        # Discard the body
+        if chunked:
+            while True:
+                n = int(f.readline().split(b';')[0], 16)
+                if n == 0:
+                    while f.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                f.read(n + 2)
+        elif length != None:
+            f.read(length)
+        else:
+            # Body runs to the end of the connection
+            f.read()
+            close = True
+        return status, close
@@ -27,23 +27,71 @@
 IDLE_TICKER = 200
 STATUS_TICKER = 10
 
+# Devices, id : serial port
+# Every request carries a device id, ALL_DEVICES addresses them all
+DEVICE_PORTS = {0 : '/dev/ttyUSB0'}
+DEVICE_PORTS_WIN = {0 : 'COM5'}
+ALL_DEVICES = 255
+# Device discovery
+# USB description set on the WSPRlite serial bridge at manufacture
+WSPRLITE_DESCRIPTION = 'SOTAbeams WSPRlite'
+# Seconds to wait for the Version response when probing a port
+PROBE_TIMEOUT = 0.5
+# Seconds between scans for unplugged and returning devices
+DISCOVERY_INTERVAL = 2.0
+
 # Server connection info
 RQST_IP = '0.0.0.0'
 RQST_PORT = 10001
+# Datagram size before negotiation and largest size supported
+WIRE_MIN_DATAGRAM = 512
+WIRE_MAX_DATAGRAM = 8192
+# Deepest nesting of tuples and dicts in a datagram
+WIRE_MAX_DEPTH = 16
+# Seconds after its last request that a client stops getting notifications
+CLIENT_TIMEOUT = 600
+# Seconds a subscription lasts unless renewed
+SUBSCRIBE_LEASE = 60
+
+# Server metrics
+# Prometheus text file rewritten every METRICS_INTERVAL seconds, None for no file
+METRICS_FILE = 'wsprlite.prom'
+# Seconds between counter rate updates and file writes
+METRICS_INTERVAL = 15
+
+# Device config cache
+# Seconds before a cached callsign/locator/frequency is read again from the
+# device, None to keep until a write changes it
+CACHE_MAX_AGE = None
+# Reads kept outstanding when taking a full config snapshot
+READ_ALL_DEPTH = 4
 
 # RPiWebRelay address for LPF selection
 WEBRELAY_ENABLE = True
 WEBRELAY_IP = '192.168.1.115'
 WEBRELAY_PORT = 8080
+# Seconds to wait for the relay server to connect or respond
+WEBRELAY_TIMEOUT = 2.0
+# Seconds the last relay selection is trusted, after that the next
+# selection is sent in full even if unchanged. Nothing is checked while idle.
+WEBRELAY_CACHE_MAX_AGE = 300
 BANDS_AVAILABLE = ('160','80','40','20','15','10')
 
 # FRITuner enable
 TUNER_ENABLE = True
+# Seconds the last tuner memory is trusted, after that the next selection
+# is sent even if unchanged. Nothing is checked while idle.
+TUNER_CACHE_MAX_AGE = 300
 
 # Client connection info
 SERVER_IP = '192.168.1.115'
 #SERVER_IP = '192.168.1.9'
 SERVER_PORT = 10001
+# Requests outstanding at once and seconds before one is failed
+CLIENT_MAX_IN_FLIGHT = 8
+CLIENT_REQUEST_TIMEOUT = 3
+# Commands waiting to be sent, not counting merged reads and frequency changes
+CLIENT_QUEUE_SIZE = 16
 
 # Timer commands
 WAIT_START = 0
@@ -56,6 +104,8 @@ TX_CYCLING = 'TX-CYCLING'
 WAIT_STOP = 'WAIT-STOP'
 
 # Request types
+UNKNOWN = 'unknown'
+HELLO = 'hello'
 GET_CALLSIGN = 'get-callsign'
 GET_LOCATOR = 'get-locator'
 GET_FREQ = 'get-freq'
@@ -64,3 +114,20 @@ SET_BAND = 'set-band'
 SET_TX = 'set-tx'
 SET_IDLE = 'set-idle'
 GET_STATUS = 'get-status'
+GET_VAR = 'get-var'
+SET_VAR = 'set-var'
+GET_CONFIG = 'get-config'
+SET_PLAN = 'set-plan'
+CANCEL_PLAN = 'cancel-plan'
+GET_PLAN = 'get-plan'
+START_HOP = 'start-hop'
+STOP_HOP = 'stop-hop'
+GET_HOP = 'get-hop'
+SUBSCRIBE = 'subscribe'
+UNSUBSCRIBE = 'unsubscribe'
+GET_DEVICES = 'get-devices'
+GET_METRICS = 'get-metrics'
+
+# Values that can be subscribed to, changes are pushed as the response
+# to the GET request for the value
+SUBSCRIBE_TOPICS = (GET_CALLSIGN, GET_LOCATOR, GET_FREQ, GET_STATUS)
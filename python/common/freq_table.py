@@ -21,7 +21,23 @@
 #     bob@bobcowdery.plus.com
 #
 
+"""
+    WSPR band allocations.
+
+    Lookups use an index built at import of the band edges in integer Hz,
+    sorted, so a frequency is placed with one bisect rather than a scan
+    with float compares. classify() does the same for a whole array with
+    NumPy, for offline work on logged frequencies.
+"""
+
 import random
+from bisect import bisect_right
+
+# NumPy is only needed for classify()
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 #------------------------------------------------------------
 # Allocated WSPR bands
@@ -40,6 +56,25 @@ band_lookup = {
     2: (144.489900, 144.490100)
 }
 
+#------------------------------------------------------------
+# Interval index, band edges in Hz sorted by lower edge
+# The bands do not overlap so the only candidate for a frequency is the
+# band with the highest lower edge at or below it.
+def to_hz(freq):
+    return int(round(freq*1000000))
+
+band_index = sorted((to_hz(lower), to_hz(upper), band) for band, (lower, upper) in band_lookup.items())
+index_lower = [entry[0] for entry in band_index]
+index_upper = [entry[1] for entry in band_index]
+index_band = [entry[2] for entry in band_index]
+# find_band() results
+index_result = [band_lookup[band] + (band,) for band in index_band]
+# The index as arrays for classify()
+if np != None:
+    classify_lower = np.array(index_lower, dtype=np.int64)
+    classify_upper = np.array(index_upper, dtype=np.int64)
+    classify_band = np.array(index_band, dtype=np.int64)
+
 #------------------------------------------------------------
 # Return a random TX frequency within the given band.
 def get_tx_freq(band):
@@ -48,16 +83,43 @@ def get_tx_freq(band):
 
 #------------------------------------------------------------
 # Given a frequency find the band it falls inside
+# freq is in MHz and is compared to the band edges to the nearest Hz
 def find_band(freq):
-    for band in band_lookup.keys():
-        lower = band_lookup[band][0]
-        upper = band_lookup[band][1]
-        if freq >= lower and freq <= upper:
-            # Success
-            return lower, upper, band
+    hz = int(round(freq*1000000))
+    n = bisect_right(index_lower, hz) - 1
+    if n >= 0 and hz <= index_upper[n]:
+        # Success
+        return index_result[n]
     # Failed!
     return None
 
+#------------------------------------------------------------
+# Given a frequency in Hz return the band or None
+def find_band_hz(hz):
+    n = bisect_right(index_lower, hz) - 1
+    if n >= 0 and hz <= index_upper[n]:
+        return index_band[n]
+    return None
+
+#------------------------------------------------------------
+# Classify an array of frequencies in one call
+# freqs is array-like in MHz, or in Hz if hz is True
+# Returns an int array of bands the shape of freqs, 0 where a frequency is
+# in no band
+def classify(freqs, hz = False):
+    if np == None:
+        raise RuntimeError('classify() requires NumPy')
+    if hz:
+        f = np.asarray(freqs, dtype=np.int64)
+    else:
+        f = np.rint(np.asarray(freqs, dtype=np.float64)*1000000).astype(np.int64)
+    n = np.searchsorted(classify_lower, f, side='right') - 1
+    # Below the lowest band, index 0 so the lookups stay in range
+    valid = n >= 0
+    n = np.maximum(n, 0)
+    valid = valid & (f <= classify_upper[n])
+    return np.where(valid, classify_band[n], 0)
+
 #------------------------------------------------------------
 # String copy of band limits.
 def get_band_limits():
@@ -75,4 +137,35 @@ def get_band_limits():
 6: (50.294400, 50.294600)   
 2: (144.489900, 144.490100)
 '''
-    
\ No newline at end of file
+    
+
+#------------------------------------------------------------
+# Module test, compare with the linear scan this replaced
+if __name__ == '__main__':
+    import timeit
+
+    def find_band_linear(freq):
+        for band in band_lookup.keys():
+            lower = band_lookup[band][0]
+            upper = band_lookup[band][1]
+            if freq >= lower and freq <= upper:
+                return lower, upper, band
+        return None
+
+    # Half in band, half random across HF
+    rng = random.Random(1)
+    n = 1000000
+    freqs = [get_tx_freq(rng.choice(list(band_lookup))) if i % 2 else round(rng.uniform(1.0, 150.0), 6) for i in range(n)]
+    for f in freqs[:100000]:
+        assert find_band(f) == find_band_linear(f), f
+    print('%d frequencies' % n)
+    t = timeit.timeit(lambda: [find_band_linear(f) for f in freqs], number=1)
+    print('linear scan  %8.3f s %8.0f ns/freq' % (t, t*1e9/n))
+    t = timeit.timeit(lambda: [find_band(f) for f in freqs], number=1)
+    print('bisect index %8.3f s %8.0f ns/freq' % (t, t*1e9/n))
+    if np != None:
+        a = np.array(freqs)
+        bands = classify(a)
+        assert all(bands[i] == (find_band(freqs[i]) or (0, 0, 0))[2] for i in range(100000))
+        t = min(timeit.repeat(lambda: classify(a), number=1, repeat=5))
+        print('classify     %8.3f s %8.1f ns/freq' % (t, t*1e9/n))
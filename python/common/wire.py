@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+#
+# wire.py
+#
+# Copyright (C) 2020 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    Binary wire protocol between client and server.
+
+    Messages are the same tuples as used in the application,
+    (type, value, ...), encoded as:
+
+        datagram ::= header values
+        header ::= version opcode device requestId
+        version ::= uint8
+        opcode ::= uint8            ; request type, see OPCODES
+        device ::= uint8            ; device id, ALL_DEVICES for every device
+        requestId ::= uint16        ; echoed in the response, 0 if unsolicited
+        values ::= value*
+        value ::= tag data
+
+    All integers are little-endian. Tags are:
+
+        'N'     None, no data
+        'T' 'F' True, False, no data
+        'i'     int64
+        'u'     uint64                      ; ints too large for int64
+        'd'     float64
+        's'     uint16 length, utf-8 bytes
+        'b'     uint16 length, bytes
+        't'     uint16 count, value*       ; tuple or list
+        'm'     uint16 count, (value value)*   ; dict
+
+    Only these types can be decoded so a datagram cannot execute code.
+    Tuples and dicts nest at most WIRE_MAX_DEPTH deep.
+
+    The datagram size is negotiated with a HELLO request carrying the
+    largest datagram the client can receive. The server replies with the
+    size it will use, the smaller of the two. Until then WIRE_MIN_DATAGRAM
+    is assumed.
+"""
+
+# Python imports
+import struct
+
+# Application imports
+from common.defs import *
+
+# Protocol version
+WIRE_VERSION = 2
+
+HEADER = struct.Struct('<BBBH')
+U16 = struct.Struct('<H')
+I64 = struct.Struct('<q')
+U64 = struct.Struct('<Q')
+F64 = struct.Struct('<d')
+
+# Request type : opcode
+OPCODES = {
+    UNKNOWN : 0,
+    HELLO : 1,
+    GET_CALLSIGN : 2,
+    GET_LOCATOR : 3,
+    GET_FREQ : 4,
+    SET_FREQ : 5,
+    SET_BAND : 6,
+    SET_TX : 7,
+    SET_IDLE : 8,
+    GET_STATUS : 9,
+    GET_VAR : 10,
+    SET_VAR : 11,
+    GET_CONFIG : 12,
+    SET_PLAN : 13,
+    CANCEL_PLAN : 14,
+    GET_PLAN : 15,
+    START_HOP : 16,
+    STOP_HOP : 17,
+    GET_HOP : 18,
+    SUBSCRIBE : 19,
+    UNSUBSCRIBE : 20,
+    GET_DEVICES : 21,
+    GET_METRICS : 22,
+}
+TYPES = {opcode : type for type, opcode in OPCODES.items()}
+
+#========================================================================
+# Raised for any datagram that cannot be encoded or decoded
+class WireError(Exception):
+    pass
+
+#------------------------------------------------------------
+# Encode a message
+def encode(rid, msg, device = 0):
+    """
+    Encode a message
+
+    Arguments:
+        rid     --  request id 0-65535
+        msg     --  (type, value, ...)
+        device  --  device id 0-255
+
+    Returns the datagram bytes
+    """
+
+    opcode = OPCODES.get(msg[0])
+    if opcode == None:
+        raise WireError('Unknown message type [%s]' % str(msg[0]))
+    try:
+        out = [HEADER.pack(WIRE_VERSION, opcode, device, rid)]
+        for value in msg[1:]:
+            _encode_value(value, out)
+    except struct.error as e:
+        raise WireError('Value out of range [%s]' % str(e))
+    return b''.join(out)
+
+#------------------------------------------------------------
+# Decode a message
+def decode(data):
+    """
+    Decode a datagram
+
+    Arguments:
+        data    --  datagram bytes
+
+    Returns (rid, device, (type, value, ...))
+    """
+
+    try:
+        version, opcode, device, rid = HEADER.unpack_from(data, 0)
+    except struct.error:
+        raise WireError('Datagram too short')
+    if version != WIRE_VERSION:
+        raise WireError('Unsupported protocol version [%d]' % version)
+    type = TYPES.get(opcode)
+    if type == None:
+        raise WireError('Unknown opcode [%d]' % opcode)
+    msg = [type]
+    pos = HEADER.size
+    try:
+        while pos < len(data):
+            value, pos = DECODERS[data[pos]](data, pos + 1, 0)
+            msg.append(value)
+    except (struct.error, IndexError, UnicodeDecodeError, TypeError):
+        raise WireError('Malformed datagram')
+    return rid, device, tuple(msg)
+
+#------------------------------------------------------------
+# Value encoders by Python type, each appends the parts to out
+def _encode_none(value, out):
+    out.append(b'N')
+
+def _encode_bool(value, out):
+    out.append(b'T' if value else b'F')
+
+def _encode_int(value, out):
+    if value > 0x7fffffffffffffff:
+        out.append(b'u' + U64.pack(value))
+    else:
+        out.append(b'i' + I64.pack(value))
+
+def _encode_float(value, out):
+    out.append(b'd' + F64.pack(value))
+
+def _encode_str(value, out):
+    b = value.encode('utf-8')
+    out.append(b's' + U16.pack(len(b)) + b)
+
+def _encode_bytes(value, out):
+    out.append(b'b' + U16.pack(len(value)) + bytes(value))
+
+def _encode_tuple(value, out):
+    out.append(b't' + U16.pack(len(value)))
+    for v in value:
+        _encode_value(v, out)
+
+def _encode_dict(value, out):
+    out.append(b'm' + U16.pack(len(value)))
+    for k, v in value.items():
+        _encode_value(k, out)
+        _encode_value(v, out)
+
+ENCODERS = {
+    type(None) : _encode_none,
+    bool : _encode_bool,
+    int : _encode_int,
+    float : _encode_float,
+    str : _encode_str,
+    bytes : _encode_bytes,
+    bytearray : _encode_bytes,
+    tuple : _encode_tuple,
+    list : _encode_tuple,
+    dict : _encode_dict,
+}
+
+#------------------------------------------------------------
+# Encode one value appending the parts to out
+def _encode_value(value, out):
+    encoder = ENCODERS.get(type(value))
+    if encoder == None:
+        raise WireError('Cannot encode type [%s]' % type(value).__name__)
+    encoder(value, out)
+
+#------------------------------------------------------------
+# Value decoders by tag, each returns (value, next position)
+# depth is the number of tuples and dicts the value is in
+def _decode_none(data, pos, depth):
+    return None, pos
+
+def _decode_true(data, pos, depth):
+    return True, pos
+
+def _decode_false(data, pos, depth):
+    return False, pos
+
+def _decode_int(data, pos, depth):
+    return I64.unpack_from(data, pos)[0], pos + 8
+
+def _decode_uint(data, pos, depth):
+    return U64.unpack_from(data, pos)[0], pos + 8
+
+def _decode_float(data, pos, depth):
+    return F64.unpack_from(data, pos)[0], pos + 8
+
+def _decode_bytes(data, pos, depth = 0):
+    n = U16.unpack_from(data, pos)[0]
+    pos += 2
+    if pos + n > len(data):
+        raise IndexError
+    return bytes(data[pos:pos+n]), pos + n
+
+def _decode_str(data, pos, depth):
+    b, pos = _decode_bytes(data, pos)
+    return b.decode('utf-8'), pos
+
+def _decode_tuple(data, pos, depth):
+    if depth >= WIRE_MAX_DEPTH:
+        raise WireError('Nesting too deep')
+    n = U16.unpack_from(data, pos)[0]
+    pos += 2
+    items = []
+    for i in range(n):
+        value, pos = DECODERS[data[pos]](data, pos + 1, depth + 1)
+        items.append(value)
+    return tuple(items), pos
+
+def _decode_dict(data, pos, depth):
+    if depth >= WIRE_MAX_DEPTH:
+        raise WireError('Nesting too deep')
+    n = U16.unpack_from(data, pos)[0]
+    pos += 2
+    items = {}
+    for i in range(n):
+        key, pos = DECODERS[data[pos]](data, pos + 1, depth + 1)
+        items[key], pos = DECODERS[data[pos]](data, pos + 1, depth + 1)
+    return items, pos
+
+def _decode_unknown(data, pos, depth):
+    raise WireError('Unknown value tag [%d]' % data[pos - 1])
+
+DECODERS = [_decode_unknown] * 256
+for tag, decoder in ((b'N', _decode_none), (b'T', _decode_true), (b'F', _decode_false),
+                     (b'i', _decode_int), (b'u', _decode_uint), (b'd', _decode_float), (b's', _decode_str),
+                     (b'b', _decode_bytes), (b't', _decode_tuple), (b'm', _decode_dict)):
+    DECODERS[tag[0]] = decoder
+
+#------------------------------------------------------------
+# Module test, compare with pickle
+if __name__ == '__main__':
+    import pickle
+    import timeit
+
+    msgs = (
+        ('request', (GET_STATUS,)),
+        ('status reply', (GET_STATUS, (True, TX_CYCLING))),
+        ('set freq', (SET_FREQ, 14.0971)),
+        ('freq reply', (GET_FREQ, (True, 14097100))),
+        ('config reply', (GET_CONFIG, (True, {'WSPR_callsign' : 'G3UKB', 'WSPR_locator' : 'IO91', 'WSPR_txFreq' : 14097100, 'WSPR_txPct' : 20}))),
+    )
+    print('%-14s %10s %10s %10s %10s %7s %7s' % ('message', 'enc us', 'pkl us', 'dec us', 'unpkl us', 'bytes', 'pkl'))
+    for name, msg in msgs:
+        data = encode(1, msg)
+        assert decode(data) == (1, 0, msg)
+        pickled = pickle.dumps(msg)
+        n = 100000
+        t = [timeit.timeit(f, number=n)*1e6/n for f in (
+            lambda: encode(1, msg), lambda: pickle.dumps(msg),
+            lambda: decode(data), lambda: pickle.loads(pickled))]
+        print('%-14s %10.2f %10.2f %10.2f %10.2f %7d %7d' % (name, t[0], t[1], t[2], t[3], len(data), len(pickled)))
@@ -23,30 +23,51 @@
 
 # Python imports
 import os, sys
-from time import sleep
-import pickle
+from time import sleep, monotonic
+from functools import partial
+import argparse
 
 # Application imports
 sys.path.append('..')
 from common.defs import *
 import device
+import discovery
 import netif
+import metrics
+
+CONNECTED = metrics.gauge('wsprlite_device_connected', '1 if the device is connected', ('device',))
 
 #========================================================================
 # Main program for the WSPRLite remote operation.
+# Each device has its own serial worker, timer and scheduler so a slow or
+# busy device does not hold up requests to the others.
 class WSPRLiteMain:
     
     #----------------------------------------------
     # Constructor
-    def __init__(self):
+    def __init__(self, devices = None):
+        """
+        Constructor
         
-        # Create the device instance
-        if sys.platform == 'win32' or sys.platform == 'win64':
-            path = 'COM5'
-        else:
-            # Assume Linux
-            path = '/dev/ttyUSB0'   
-        self.__lite = device.WSPRLite(path, self.__startCallback, self.__stopCallback)
+        Arguments:
+            devices --  device id : serial port, default DEVICE_PORTS
+        
+        """
+        
+        if devices == None:
+            if sys.platform == 'win32' or sys.platform == 'win64':
+                devices = DEVICE_PORTS_WIN
+            else:
+                # Assume Linux
+                devices = DEVICE_PORTS
+        # Create the device instances
+        self.__lites = {}
+        for dev, path in devices.items():
+            self.__lites[dev] = device.WSPRLite(path, partial(self.__startCallback, dev), partial(self.__stopCallback, dev), partial(self.__changeCallback, dev))
+        
+        # Reconnect devices that are unplugged or not yet plugged in
+        self.__watcher = discovery.Watcher(self.__lites)
+        self.__watcher.start()
         
         # Run the net interface as this is the active thread.
         self.__netif = netif.NetIF(self.__netCallback)
@@ -58,77 +79,215 @@ class WSPRLiteMain:
         
         print('WSPRLite remote interface running ...')
         try:
-            # Main loop for ever, does nothing
+            # Main loop for ever, updates the metrics
+            next_metrics = monotonic() + METRICS_INTERVAL
             while True:
-                sleep(1)                                
+                sleep(1)
+                if monotonic() >= next_metrics:
+                    next_metrics += METRICS_INTERVAL
+                    self.__updateMetrics()
         except KeyboardInterrupt:  
             # User requested exit
             # Terminate the netif thread and wait for it to close
             self.__netif.terminate()
             self.__netif.join()
-            # and the device
-            self.__lite.terminate()
+            # and the devices
+            self.__watcher.terminate()
+            self.__watcher.join()
+            for lite in self.__lites.values():
+                lite.terminate()
             
             print('Interrupt - exiting...')
     
     #----------------------------------------------
     # Callback when data received          
-    def __netCallback(self, data):
+    def __netCallback(self, request, address, rid, dev):
         
         # Data arrived from caller
-        try:
-            request = pickle.loads(data)
-            # request is an array of type followed by one or more parameters
-            type = request[0]
-            if type == GET_CALLSIGN:
-                print("Received: GET_CALLSIGN")
-                self.__netif.response((GET_CALLSIGN, self.__lite.get_callsign()))
-            elif type == GET_LOCATOR:
-                print("Received: GET_LOCATOR")
-                self.__netif.response((GET_LOCATOR, self.__lite.get_locator()))
-            elif type == GET_FREQ:
-                print("Received: GET_FREQ")
-                self.__netif.response((GET_FREQ, self.__lite.get_freq()))
-            elif type == SET_FREQ:
-                print("Received: SET_FREQ")
-                if len(request) != 2:
-                    self.__netif.response((SET_FREQ, (False, "Error - wrong number of parameters!")))
-                else:
-                    self.__netif.response((SET_FREQ, self.__lite.set_freq(request[1])))
-            elif type == SET_BAND:
-                print("Received: SET_BAND")
-                if len(request) != 2:
-                    self.__netif.response((SET_BAND, (False, "Error - wrong number of parameters!")))
-                else:
-                    self.__netif.response((SET_BAND, self.__lite.set_band(request[1]))) 
-            elif type == SET_TX:
-                print("Received: SET_TX")
-                self.__lite.set_tx()
-                #self.__netif.response((SET_TX, self.__lite.set_tx()))
-            elif type == SET_IDLE:
-                print("Received: SET_IDLE")
-                self.__lite.set_idle()
-                #self.__netif.response((SET_IDLE, self.__lite.set_idle()))
-            elif type == GET_STATUS:
-                self.__netif.response((GET_STATUS, self.__lite.get_status()))
-        except pickle.UnpicklingError:
-            self.__netif.response(('UNKNOWN', (False, 'Failed to unpickle request data!')))
+        # request is an array of type followed by one or more parameters
+        # dev is the device id the request is for
+        type = request[0]
+        # Requests not for a single device
+        if type == GET_DEVICES:
+            # Port, connection state and recovery times of each device
+            self.__netif.response((GET_DEVICES, (True, {n : lite.get_link()[1] for n, lite in self.__lites.items()})), address, rid, dev)
+            return
+        elif type == GET_METRICS:
+            # All metrics or those whose name starts with the argument
+            prefix = request[1] if len(request) == 2 and isinstance(request[1], str) else ''
+            self.__netif.response((GET_METRICS, (True, metrics.registry.snapshot(prefix))), address, rid, dev)
+            return
+        elif type == GET_STATUS and dev == ALL_DEVICES:
+            self.__netif.response((GET_STATUS, (True, {n : lite.get_status()[1] for n, lite in self.__lites.items()})), address, rid, dev)
+            return
+        elif type == SUBSCRIBE and dev == ALL_DEVICES:
+            self.__subscribe(request, address, rid, dev)
+            return
+        elif type == UNSUBSCRIBE and dev == ALL_DEVICES:
+            self.__netif.response((UNSUBSCRIBE, (self.__netif.unsubscribe(address, dev), '')), address, rid, dev)
+            return
+        lite = self.__lites.get(dev)
+        if lite == None:
+            self.__netif.response((type, (False, 'Unknown device %d!' % dev)), address, rid, dev)
+            return
+        if type == GET_CALLSIGN:
+            print("Received: GET_CALLSIGN")
+            self.__respond(GET_CALLSIGN, lite.get_callsign(), address, rid, dev)
+        elif type == GET_LOCATOR:
+            print("Received: GET_LOCATOR")
+            self.__respond(GET_LOCATOR, lite.get_locator(), address, rid, dev)
+        elif type == GET_FREQ:
+            print("Received: GET_FREQ")
+            self.__respond(GET_FREQ, lite.get_freq(), address, rid, dev)
+        elif type == SET_FREQ:
+            print("Received: SET_FREQ")
+            if len(request) != 2:
+                self.__netif.response((SET_FREQ, (False, "Error - wrong number of parameters!")), address, rid, dev)
+            else:
+                self.__respond(SET_FREQ, lite.set_freq(request[1]), address, rid, dev)
+        elif type == SET_BAND:
+            print("Received: SET_BAND")
+            if len(request) != 2:
+                self.__netif.response((SET_BAND, (False, "Error - wrong number of parameters!")), address, rid, dev)
+            else:
+                self.__respond(SET_BAND, lite.set_band(request[1]), address, rid, dev)
+        elif type == SET_TX:
+            print("Received: SET_TX")
+            lite.set_tx()
+            # Accepted, the start is broadcast to every client when TX is armed
+            self.__netif.response((SET_TX, (True, '')), address, rid, dev)
+        elif type == SET_IDLE:
+            print("Received: SET_IDLE")
+            lite.set_idle()
+            self.__netif.response((SET_IDLE, (True, '')), address, rid, dev)
+        elif type == GET_STATUS:
+            self.__netif.response((GET_STATUS, lite.get_status()), address, rid, dev)
+        elif type == GET_VAR:
+            print("Received: GET_VAR")
+            if len(request) != 2 or request[1] not in device.var_lookup:
+                self.__netif.response((GET_VAR, (False, "Error - unknown variable!")), address, rid, dev)
+            else:
+                self.__respond(GET_VAR, lite.read_var(device.var_lookup[request[1]]), address, rid, dev)
+        elif type == SET_VAR:
+            print("Received: SET_VAR")
+            if len(request) != 3 or request[1] not in device.var_lookup:
+                self.__netif.response((SET_VAR, (False, "Error - unknown variable or wrong number of parameters!")), address, rid, dev)
+            else:
+                self.__respond(SET_VAR, lite.write_var(device.var_lookup[request[1]], request[2]), address, rid, dev)
+        elif type == GET_CONFIG:
+            print("Received: GET_CONFIG")
+            self.__respond(GET_CONFIG, lite.read_all(), address, rid, dev)
+        elif type == SET_PLAN:
+            print("Received: SET_PLAN")
+            if len(request) != 2:
+                self.__netif.response((SET_PLAN, (False, "Error - wrong number of parameters!")), address, rid, dev)
+            else:
+                self.__netif.response((SET_PLAN, lite.load_plan(request[1])), address, rid, dev)
+        elif type == CANCEL_PLAN:
+            print("Received: CANCEL_PLAN")
+            self.__netif.response((CANCEL_PLAN, lite.cancel_plan()), address, rid, dev)
+        elif type == GET_PLAN:
+            self.__netif.response((GET_PLAN, lite.get_plan()), address, rid, dev)
+        elif type == START_HOP:
+            print("Received: START_HOP")
+            if len(request) != 2:
+                self.__netif.response((START_HOP, (False, "Error - wrong number of parameters!")), address, rid, dev)
+            else:
+                self.__netif.response((START_HOP, lite.start_hop(request[1])), address, rid, dev)
+        elif type == STOP_HOP:
+            print("Received: STOP_HOP")
+            self.__netif.response((STOP_HOP, lite.stop_hop()), address, rid, dev)
+        elif type == GET_HOP:
+            self.__netif.response((GET_HOP, lite.get_hop()), address, rid, dev)
+        elif type == SUBSCRIBE:
+            self.__subscribe(request, address, rid, dev)
+        elif type == UNSUBSCRIBE:
+            print("Received: UNSUBSCRIBE")
+            self.__netif.response((UNSUBSCRIBE, (self.__netif.unsubscribe(address, dev), '')), address, rid, dev)
+        else:
+            self.__netif.response((UNKNOWN, (False, 'Unknown request!')), address, rid, dev)
 
+    #----------------------------------------------
+    # Update counter rates and gauges and write the Prometheus file
+    def __updateMetrics(self):
+        
+        for dev, lite in self.__lites.items():
+            CONNECTED.set(1 if lite.connected() else 0, dev)
+        metrics.registry.tick()
+        if METRICS_FILE != None:
+            try:
+                metrics.registry.write(METRICS_FILE)
+            except OSError as e:
+                print('Failed to write metrics file [%s]' % str(e))
+    
+    #----------------------------------------------
+    # Subscribe to topics on a device or ALL_DEVICES
+    def __subscribe(self, request, address, rid, dev):
+        
+        print("Received: SUBSCRIBE")
+        if len(request) != 2 or len(request[1]) == 0 or not set(request[1]).issubset(SUBSCRIBE_TOPICS):
+            self.__netif.response((SUBSCRIBE, (False, "Error - unknown topic!")), address, rid, dev)
+        else:
+            self.__netif.subscribe(address, request[1], dev)
+            self.__netif.response((SUBSCRIBE, (True, SUBSCRIBE_LEASE)), address, rid, dev)
+    
+    #----------------------------------------------
+    # Send the response when the device exchange completes
+    # This does not wait so the net thread can continue to accept requests
+    def __respond(self, type, future, address, rid, dev):
+        
+        def done(f):
+            try:
+                self.__netif.response((type, f.result()), address, rid, dev)
+            except Exception as e:
+                self.__netif.response((type, (False, 'Device error [%s]' % str(e))), address, rid, dev)
+        future.add_done_callback(done)
+    
+    #----------------------------------------------
+    # Callback when the TX status or a watched variable changes
+    # Sent to subscribers as the response to the GET request
+    def __changeCallback(self, dev, type, value):
+        self.__netif.publish(type, (type, (True, value)), dev)
+    
     #----------------------------------------------
     # Callback when TX activated          
-    def __startCallback(self, data):
-        self.__netif.response((SET_TX, data))
+    # TX state changes are sent to every client
+    def __startCallback(self, dev, data):
+        self.__netif.broadcast((SET_TX, data), dev)
     
     #----------------------------------------------
     # Callback when TX stopped          
-    def __stopCallback(self, data):
-        self.__netif.response((SET_IDLE, data))
+    def __stopCallback(self, dev, data):
+        self.__netif.broadcast((SET_IDLE, data), dev)
         
 #========================================================================
 # Entry point            
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='WSPRLite remote interface')
+    parser.add_argument('--emulate', type=int, default=0, metavar='N', help='run against N emulated devices')
+    parser.add_argument('--discover', action='store_true', help='use the WSPRLites found on the USB ports')
+    args = parser.parse_args()
+    devices = None
+    emulators = []
+    if args.discover:
+        # Device ids 0..N-1 in DeviceId order
+        found = discovery.scan()
+        if len(found) == 0:
+            print('No WSPRLite found, using the configured ports')
+        else:
+            devices = {dev : f['port'] for dev, f in enumerate(found)}
+    elif args.emulate > 0:
+        # Device ids 0..N-1 on emulated serial ports
+        import emulator
+        devices = {}
+        for dev in range(args.emulate):
+            emulators.append(emulator.Emulator())
+            emulators[dev].start()
+            devices[dev] = emulators[dev].port()
     # Create an instance of the main program
-    main = WSPRLiteMain()
+    main = WSPRLiteMain(devices)
     # Run until terminated
-    main.mainLoop()        
+    main.mainLoop()
+    for emu in emulators:
+        emu.terminate()        
     
\ No newline at end of file
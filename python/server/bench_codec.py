@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+#
+# bench_codec.py
+#
+# Copyright (C) 2019 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    Micro-benchmarks for the protocol code in device.py.
+
+    Every exchange with the device goes through the frame builder, the
+    escape codec, the CRC and the response decoder. Each case is timed
+    and the peak memory allocated while processing one frame is measured
+    with tracemalloc.
+
+    Usage:
+        python3 bench_codec.py              run and compare with the baseline
+        python3 bench_codec.py --save       run and store a new baseline
+
+    The exit status is 1 if any case is slower than the baseline by more
+    than the tolerance or allocates more bytes per frame than the baseline
+    plus a few bytes of slack, less than any new object, so the suite can
+    gate a CI run.
+
+    The baseline is kept in bench_baseline.json beside this script. The
+    allocations are the same on any machine with the same Python version
+    but the rates are not, so run --save once on the machine that gates
+    the build and commit the result.
+"""
+
+# Python imports
+import os, sys
+import struct
+import json
+import timeit
+import tracemalloc
+import argparse
+
+# Application imports
+sys.path.append('..')
+from device import *
+
+# Default baseline file, beside this script
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+#========================================================================
+# Payloads
+FREQ = struct.pack('<Q', 14097100)
+# Every byte needs escaping
+ALL_CONTROL = (START + END + ESC) * 5
+
+#----------------------------------------------
+# Decode a frame fed in one read
+def decode_bulk(frame):
+    return FrameDecoder().feed(frame)
+
+#----------------------------------------------
+# Decode a frame fed a byte at a time, the worst case for the buffer
+def decode_bytes(frame):
+    decoder = FrameDecoder()
+    for n in range(len(frame)):
+        msgs = decoder.feed(frame[n:n+1])
+    return msgs
+
+#----------------------------------------------
+# Build the benchmark cases as (name, callable, argument)
+def cases():
+    read_frame = build_frame(MsgType.Read.value, VarId.WSPR_txFreq.value)
+    freq_resp = build_frame(MsgType.ResponseData.value, FREQ)
+    ctrl_resp = build_frame(MsgType.ResponseData.value, ALL_CONTROL)
+    call_resp = build_frame(MsgType.ResponseData.value, b'G3UKB\0\0\0\0\0\0\0\0\0\0')
+    escaped_ctrl = escape(ALL_CONTROL)
+    crc = WSPRLite.calc_crc_32
+    return (
+        ('build read', lambda a: build_frame(*a), (MsgType.Read.value, VarId.WSPR_txFreq.value)),
+        ('build write freq', lambda a: build_frame(*a), (MsgType.Write.value, VarId.WSPR_txFreq.value, FREQ)),
+        ('build write all-control', lambda a: build_frame(*a), (MsgType.Write.value, VarId.WSPR_txFreq.value, ALL_CONTROL)),
+        ('read frame precompiled', lambda a: read_frames[a], VarId.WSPR_txFreq),
+        ('freq frame generic', lambda a: build_frame(MsgType.Write.value, VarId.WSPR_txFreq.value, var_codecs[VarId.WSPR_txFreq].encode(a)), 14097100),
+        ('freq frame packed', build_freq_frame, 14097100),
+        ('escape freq', escape, FREQ),
+        ('escape all-control', escape, ALL_CONTROL),
+        ('unescape freq', unescape, escape(FREQ)),
+        ('unescape all-control', unescape, escaped_ctrl),
+        ('crc32 read', lambda a: crc(None, a), MsgType.Read.value + VarId.WSPR_txFreq.value),
+        ('crc32 all-control', lambda a: crc(None, a), ALL_CONTROL),
+        ('decode ack', decode_bulk, build_frame(MsgType.ACK.value)),
+        ('decode freq', decode_bulk, freq_resp),
+        ('decode callsign', decode_bulk, call_resp),
+        ('decode all-control', decode_bulk, ctrl_resp),
+        ('decode freq bytewise', decode_bytes, freq_resp),
+        ('decode read request', decode_bulk, read_frame),
+    )
+
+#----------------------------------------------
+# Frames per second, best of several runs
+def rate(fn, arg):
+    timer = timeit.Timer(lambda: fn(arg))
+    number, t = timer.autorange()
+    best = min(timer.repeat(repeat=5, number=number))
+    return number / best
+
+#----------------------------------------------
+# Peak bytes allocated while processing one frame
+# The least of several runs so the interpreter's own allocations do not
+# show as a regression
+def allocated(fn, arg, repeat = 5):
+    fn(arg)
+    tracemalloc.start()
+    least = None
+    for n in range(repeat):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn(arg)
+        peak = tracemalloc.get_traced_memory()[1] - base
+        least = peak if least == None else min(least, peak)
+    tracemalloc.stop()
+    return least
+
+#----------------------------------------------
+# Run all cases
+def run():
+    results = {}
+    for name, fn, arg in cases():
+        results[name] = {'rate' : rate(fn, arg), 'bytes' : allocated(fn, arg)}
+    return results
+
+#========================================================================
+# Entry point
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Protocol codec benchmarks')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown as a fraction')
+    parser.add_argument('--alloc-slack', type=int, default=16, help='allowed extra bytes allocated per frame')
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = run()
+    regressed = []
+    print('%-26s %14s %10s %12s %12s' % ('case', 'frames/s', 'alloc B', 'rate vs base', 'alloc vs base'))
+    for name, r in results.items():
+        change = ''
+        alloc = ''
+        if name in baseline:
+            ratio = r['rate'] / baseline[name]['rate']
+            change = '%+.1f%%' % ((ratio - 1.0) * 100)
+            if ratio < 1.0 - args.tolerance:
+                change += ' SLOW'
+            alloc = '%+d' % (r['bytes'] - baseline[name]['bytes'])
+            if r['bytes'] > baseline[name]['bytes'] + args.alloc_slack:
+                alloc += ' MORE'
+            if change.endswith('SLOW') or alloc.endswith('MORE'):
+                regressed.append(name)
+        print('%-26s %14.0f %10d %12s %12s' % (name, r['rate'], r['bytes'], change, alloc))
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('Baseline saved to %s' % args.baseline)
+    elif len(regressed) > 0:
+        print('Regressions: %s' % ', '.join(regressed))
+        sys.exit(1)
@@ -228,17 +228,32 @@
 
 # Python imports
 import os,sys
+import math
 import serial
 import binascii
 import struct
-from enum import Enum, auto
-from time import sleep
+import threading
+from enum import Enum
+from collections import namedtuple, deque
+from concurrent.futures import Future
+import time
+from time import sleep, monotonic
+
+# Errors from a port whose device has gone, termios is POSIX only
+try:
+    import termios
+    PORT_ERRORS = (serial.SerialException, OSError, termios.error)
+except ImportError:
+    PORT_ERRORS = (serial.SerialException, OSError)
 
 # Application imports
 sys.path.append('..')
 from common.defs import *
 from common import freq_table
 import timer
+import worker
+import scheduler
+import metrics
 
 #========================================================================
 # Enumerations transferred from the C++ Config program
@@ -303,100 +318,454 @@ class DeviceMode(Enum):
 # Message delimiters
 START = b'\x01'
 END = b'\x04'
+ESC = b'\x10'
+
+#========================================================================
+# Config variable codecs
+# See https://github.com/SOTAbeams/WSPRliteConfig/tree/master/techdoc/cfgvars.md
+
+#----------------------------------------------
+# Little-endian integer variable
+class NumCodec(object):
+    
+    def __init__(self, fmt):
+        # fmt is a struct format for the written value
+        self.__fmt = fmt
+        self.__signed = fmt[-1].islower()
+    
+    def encode(self, value):
+        return struct.pack(self.__fmt, int(value))
+    
+    def decode(self, data):
+        # Firmware versions differ in some widths so take whatever was sent
+        return int.from_bytes(data, 'little', signed=self.__signed)
+
+#----------------------------------------------
+# Null terminated ascii string variable
+class StrCodec(object):
+    
+    def __init__(self, size):
+        # size is the maximum length including the terminator
+        self.__size = size
+    
+    def encode(self, value):
+        data = value.encode("ascii") + b'\0'
+        if len(data) > self.__size:
+            raise ValueError('String too long, max %d characters' % (self.__size - 1))
+        return data
+    
+    def decode(self, data):
+        return data.split(b'\0', 1)[0].decode("ascii")
+
+# Wire type of every config variable
+var_codecs = {
+    VarId.MemVersion : NumCodec('<I'),
+    VarId.xoFreq : NumCodec('<Q'),
+    VarId.xoFreqFactory : NumCodec('<Q'),
+    VarId.ChangeCounter : NumCodec('<I'),
+    VarId.DeviceId : NumCodec('<Q'),
+    VarId.DeviceSecret : NumCodec('<Q'),
+    VarId.WSPR_txFreq : NumCodec('<Q'),
+    VarId.WSPR_locator : StrCodec(8),
+    VarId.WSPR_callsign : StrCodec(15),
+    VarId.WSPR_paBias : NumCodec('<H'),
+    VarId.WSPR_outputPower : NumCodec('<H'),
+    VarId.WSPR_reportPower : NumCodec('<B'),
+    VarId.WSPR_txPct : NumCodec('<B'),
+    VarId.WSPR_maxTxDuration : NumCodec('<I'),
+    VarId.CwId_Freq : NumCodec('<Q'),
+    VarId.CwId_Callsign : StrCodec(15),
+    VarId.PaBiasSource : NumCodec('<B'),
+}
+
+# Lookup of config variable by name
+var_lookup = {v.name : v for v in var_codecs}
+
+# Lookup of message type by its wire value
+msg_type_lookup = {m.value : m for m in MsgType}
 
-# Response states
-class State(Enum):
-    IDLE = auto()
-    START = auto()
-    ESC = auto()
-    ACK = auto()
-    NACK = auto()
-    RESP = auto()
-    DATA = auto()
-    CS = auto()
-    END = auto()
-    DONE = auto()
-
-# Response data length
-data_def = {
-    VarId.WSPR_callsign : 15,
-    VarId.WSPR_locator : 8,
-    VarId.WSPR_txFreq : 8
+# Variables whose changes are notified : GET request for the value
+watched_vars = {
+    VarId.WSPR_callsign : GET_CALLSIGN,
+    VarId.WSPR_locator : GET_LOCATOR,
+    VarId.WSPR_txFreq : GET_FREQ,
 }
+
+# Serial round trip buckets, seconds
+SERIAL_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0)
+# TX start offset buckets, seconds, the nominal start is timer.START_OFFSET
+TX_OFFSET_BUCKETS = (0.0, 0.9, 0.95, 1.0, 1.02, 1.05, 1.1, 1.2, 1.5, 2.0, 5.0)
+# Reconnect buckets, seconds
+RECOVERY_BUCKETS = (0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0, 3600.0)
+
+# Exchanges are labelled with the port, the msgType and the variable or mode
+SERIAL_RTT = metrics.histogram('wsprlite_serial_rtt_seconds', 'Serial round trip time by command', ('port', 'command', 'target'), SERIAL_BUCKETS)
+SERIAL_TIMEOUTS = metrics.counter('wsprlite_serial_timeouts_total', 'Commands the device did not answer', ('port', 'command', 'target'))
+SERIAL_NACKS = metrics.counter('wsprlite_serial_nacks_total', 'Commands the device answered with NACK', ('port', 'command', 'target'))
+TX_START_OFFSET = metrics.histogram('wsprlite_tx_start_offset_seconds', 'Seconds from the even minute to TX start being acknowledged', ('port',), TX_OFFSET_BUCKETS)
+RECOVERY = metrics.histogram('wsprlite_recovery_seconds', 'Seconds from losing a device to it being ready again', ('port',), RECOVERY_BUCKETS)
+
+#========================================================================
+# A decoded message from the device.
+#   type    --  MsgType or None if the type is unknown
+#   data    --  unescaped msgData
+#   valid   --  True if the checksum was correct
+Message = namedtuple('Message', ['type', 'data', 'valid'])
+
+#----------------------------------------------
+# Escape all control bytes in a message
+def escape(data):
+    # The esc byte must be escaped first so the esc bytes introduced for
+    # start and end are not escaped again
+    return data.replace(b'\x10', b'\x10\x90').replace(b'\x01', b'\x10\x81').replace(b'\x04', b'\x10\x84')
+
+#----------------------------------------------
+# Remove escape sequences from an escaped message
+def unescape(data):
+    # Every esc byte in an escaped message introduces an escapeSeq so the
+    # esc/esc sequence must be replaced last
+    return data.replace(b'\x10\x81', b'\x01').replace(b'\x10\x84', b'\x04').replace(b'\x10\x90', b'\x10')
+
+#----------------------------------------------
+# Build the transmitted bytes for a message
+def build_frame(*parts):
+    """
+    Build a frame
+    
+    Arguments:
+        parts   --  msgType followed by any msgData as bytes
+    
+    Returns start escapedMessage end where the checksum is the CRC32 of
+    the unescaped msgType msgData
+    """
+    
+    msg = b''.join(parts)
+    return START + escape(msg + struct.pack('<I', binascii.crc32(msg))) + END
+
+#----------------------------------------------
+# Frames that never change are built once
+# msg = START/8 + READ/16 + VarId/16 + CRC/32 + STOP/8
+read_frames = {var : build_frame(MsgType.Read.value, var.value) for var in var_codecs}
+# msg = START/8 + MsgType.DeviceMode_Set/16 + DeviceMode.WSPR_Active/16 + CRC/32 + STOP/8
+SET_TX_FRAME = build_frame(MsgType.DeviceMode_Set.value, DeviceMode.WSPR_Active.value)
+# msg = START/8 + MsgType.Reset/16 + CRC/32 + STOP/8
+RESET_FRAME = build_frame(MsgType.Reset.value)
+# msg = START/8 + MsgType.Version/16 + CRC/32 + STOP/8
+VERSION_FRAME = build_frame(MsgType.Version.value)
+
+#----------------------------------------------
+# Frequency writes are packed into a buffer kept for each thread
+# msg = WRITE/16 + WSPR_txFreq/16 + FREQ/64 + CRC/32
+FREQ_OFFSET = 4
+CRC_OFFSET = 12
+FREQ = struct.Struct('<Q')
+CRC = struct.Struct('<I')
+freq_buffers = threading.local()
+
+def build_freq_frame(hz):
+    """
+    Build a frame to write WSPR_txFreq
+    
+    Arguments:
+        hz  --  frequency in Hz
+    
+    Returns the same as build_frame() but the only new objects are the
+    escaped message and the frame
+    """
+    
+    fb = freq_buffers
+    if not hasattr(fb, 'buf'):
+        fb.buf = bytearray(MsgType.Write.value + VarId.WSPR_txFreq.value + bytes(FREQ.size + CRC.size))
+        fb.msg = memoryview(fb.buf)[:CRC_OFFSET]
+    FREQ.pack_into(fb.buf, FREQ_OFFSET, hz)
+    CRC.pack_into(fb.buf, CRC_OFFSET, binascii.crc32(fb.msg))
+    return b''.join((START, escape(bytes(fb.buf)), END))
+
+#========================================================================
+"""
+    Incremental frame decoder for responses from the WSPRLite.
+    Received bytes are accumulated in a buffer which is searched for
+    complete start ... end frames. Each frame is unescaped and the
+    checksum verified before being returned as a Message.
+"""
+class FrameDecoder(object):
     
+    #----------------------------------------------
+    # Constructor
+    def __init__(self):
+        self.__buf = bytearray()
+    
+    #----------------------------------------------
+    # Discard any partial frame
+    def reset(self):
+        del self.__buf[:]
+    
+    #----------------------------------------------
+    # Add received bytes and return a list of the complete messages
+    def feed(self, data):
+        """
+        Decode received bytes
+        
+        Arguments:
+            data    --  bytes as read from the serial port
+        
+        Returns a list of Message, empty if no frame is complete
+        """
+        
+        buf = self.__buf
+        buf += data
+        msgs = []
+        while True:
+            end = buf.find(END)
+            if end < 0:
+                # No complete frame, keep the tail from the last start
+                start = buf.rfind(START)
+                if start < 0:
+                    del buf[:]
+                elif start > 0:
+                    del buf[:start]
+                break
+            # Resync on the last start before this end, anything before it is
+            # a truncated frame or line noise
+            start = buf.rfind(START, 0, end)
+            if start >= 0:
+                msgs.append(self.decode(bytes(buf[start+1:end])))
+            del buf[:end+1]
+        return msgs
+    
+    #----------------------------------------------
+    # Decode the escaped content of a single frame
+    def decode(self, frame):
+        """
+        Decode a frame
+        
+        Arguments:
+            frame   --  the escapedMessage between start and end
+        
+        Returns a Message
+        """
+        
+        msg = unescape(frame)
+        if len(msg) < 6:
+            return Message(None, b'', False)
+        body = msg[:-4]
+        valid = struct.unpack('<I', msg[-4:])[0] == binascii.crc32(body)
+        return Message(msg_type_lookup.get(body[:2]), body[2:], valid)
+    
+#----------------------------------------------
+# Open a serial port with the settings from the device spec
+def open_port(path, timeout = 2.0):
+    """
+    Open a WSPRLite serial port
+    
+    Arguments:
+        path    --  serial port
+        timeout --  read timeout in seconds
+    
+    Returns the open serial.Serial, raises serial.SerialException if the
+    port cannot be opened
+    """
+    
+    ser = serial.Serial()
+    ser.port = path
+    ser.baudrate = 1000000
+    ser.bytesize = 8
+    ser.parity = 'N'
+    ser.stopbits = 2
+    ser.rtscts = True
+    ser.timeout = timeout
+    ser.open()
+    return ser
+
+#----------------------------------------------
+# True for an int or float that is not a bool, inf or NaN
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+#----------------------------------------------
+# A Future already completed with a failure, for requests refused before
+# they reach the serial thread
+def _failed(reason):
+    future = Future()
+    future.set_result((False, reason))
+    return future
+
 #========================================================================
 """
     Main device class for WSPRLite
+    
+    If the port is missing or the device is unplugged the instance stays
+    up and requests fail with a reason until connect() succeeds, usually
+    called by discovery.Watcher when the device comes back. Variables
+    written through the server are then written again and TX cycling
+    that was running or due is restarted at the next slot. The time from
+    losing the device to it being ready again is recorded, see get_link().
 """
 class WSPRLite(object):
     
     #----------------------------------------------
     # Constructor
-    def __init__(self, device, m_start_cb, m_stop_cb):
+    def __init__(self, device, m_start_cb, m_stop_cb, m_change_cb = None, cache_max_age = CACHE_MAX_AGE):
         
         self.__m_start_cb = m_start_cb
         self.__m_stop_cb = m_stop_cb
+        # Called as m_change_cb(type, value) when the TX status or a
+        # watched variable changes, type is the GET request for the value
+        self.__m_change_cb = m_change_cb
+        
+        # Cache of config variables read from or written to the device
+        # VarId : (value, time cached)
+        # Entries older than cache_max_age seconds are read again, None
+        # keeps them until a write changes the variable
+        self.__cache = {}
+        self.__cache_max_age = cache_max_age
+        
+        # Variables written through the server, restored on reconnect
+        # VarId : value
+        self.__written = {}
+        
+        # Connection state
+        self.__port = device
+        self.__ser = None
+        self.__device_id = None
+        self.__lost_at = monotonic()
+        # Restart TX cycling when the device is back
+        self.__resume_tx = False
+        self.__link_stats = {'disconnects' : 0, 'reconnects' : 0, 'last_recovery' : None, 'max_recovery' : None, 'last_restore' : None}
         
         # Create connection and set parameters according to device spec
         try:
-            self.__ser = serial.Serial(device)
+            self.__ser = open_port(device)
         except serial.SerialException:
-            print ("Could not open the specified serial port! [%s]" % (device))
-            sys.exit()
-        self.__ser.baudrate = 1000000
-        self.__ser.bytesize = 8
-        self.__ser.parity = 'N'
-        self.__ser.stopbits = 2
-        self.__ser.rtscts = True
-        self.__ser.timeout = 2.0
+            print ("Could not open the specified serial port, waiting for the device! [%s]" % (device))
+        
+        # Response decoder and messages decoded but not yet read
+        self.__decoder = FrameDecoder()
+        self.__msgs = deque()
+        
+        # Create the serial worker, all port access happens on this thread
+        self.__worker = worker.SerialWorker()
+        self.__worker.start()
         
         # Create timer instance
         self.__timer = timer.TimerThrd(self.__start_cb, self.__stop_cb)
         self.__timer.start()
         
+        # Create scheduler for planned TX campaigns
+        self.__scheduler = scheduler.Scheduler()
+        self.__scheduler.start()
+        self.__plan_events = []
+        # True while TX cycling was started by the plan
+        self.__plan_active = False
+        
+        # Band hopping state
+        self.__hop_start_event = None
+        self.__hop_first_event = None
+        self.__hop_event = None
+        self.__hop_bands = []
+        self.__hop_index = 0
+        self.__hop_stats = None
+        
         # TX status
         self.__status = IDLE
+        
+        # Learn which device this is so it can be recognised if it returns
+        if self.__ser != None:
+            self.__submit(self.__identify)
     
     #----------------------------------------------
     # Terminate
     def terminate(self):
         self.__timer.terminate()
         self.__timer.join()
+        self.__scheduler.terminate()
+        self.__scheduler.join()
+        self.__worker.terminate()
+        self.__worker.join()
+        if self.__ser != None:
+            self.__ser.close()
+    
+    #----------------------------------------------
+    # Connection methods
+    #----------------------------------------------
+    # Serial port in use or last used
+    def port(self):
+        return self.__port
+    
+    #----------------------------------------------
+    # True if the port is open
+    def connected(self):
+        return self.__ser != None
+    
+    #----------------------------------------------
+    # DeviceId read from the device, None until it has answered
+    def device_id(self):
+        return self.__device_id
+    
+    #----------------------------------------------
+    # Connect or reconnect
+    def connect(self, port = None):
+        """
+        Open the port and restore the device, does nothing if connected.
+        The config written through the server and TX cycling are only
+        restored if the DeviceId is the one last seen or none has been seen.
+        
+        Arguments:
+            port    --  serial port, default the port last used
+        
+        Returns a Future which completes with (True, seconds since the
+        device was lost) or (False, reason)
+        """
+        
+        return self.__worker.submit(self.__connect, self.__port if port == None else port, priority=worker.PRIORITY_TX)
+    
+    #----------------------------------------------
+    # The port has gone, close it
+    def disconnect(self, reason = 'Port removed'):
+        return self.__worker.submit(self.__lost, reason, priority=worker.PRIORITY_TX)
+    
+    #----------------------------------------------
+    # Connection state and statistics
+    # Returns (True, {port, connected, device_id, disconnects, reconnects,
+    # last_recovery, max_recovery, last_restore}), times in seconds
+    def get_link(self):
+        stats = dict(self.__link_stats)
+        stats['port'] = self.__port
+        stats['connected'] = self.__ser != None
+        stats['device_id'] = self.__device_id
+        return (True, stats)
         
+    #----------------------------------------------
+    # Read and write methods return a Future which completes with
+    # (True, data) or (False, reason) when the exchange is done.
     #----------------------------------------------
     # Read methods
     #----------------------------------------------
     # Get current callsign
     def get_callsign(self):
-        # msg = START/8 + READ/16 + WSPR_callsign/16 + CRC/32 + STOP/8
-        data = MsgType.Read.value + VarId.WSPR_callsign.value
-        crc = self.calc_crc_32(data)
-        msg = START + data + crc + END
-        self.__ser.write(msg)
-        self.__do_response(VarId.WSPR_callsign)
-        return self.__reply
+        return self.read_var(VarId.WSPR_callsign)
 
     #----------------------------------------------
     # Get current locator
     def get_locator(self):
-        # msg = START/8 + READ/16 + WSPR_locator/16 + CRC/32 + STOP/8
-        data = MsgType.Read.value + VarId.WSPR_locator.value
-        crc = self.calc_crc_32(data)
-        msg = START + data + crc + END
-        self.__ser.write(msg)
-        self.__do_response(VarId.WSPR_locator)
-        return self.__reply
+        return self.read_var(VarId.WSPR_locator)
     
     #----------------------------------------------
     # Get current transmit frequency
     def get_freq(self):
-        # msg = START/8 + READ/16 + WSPR_txFreq/16 + CRC/32 + STOP/8
-        data = MsgType.Read.value + VarId.WSPR_txFreq.value
-        crc = self.calc_crc_32(data)
-        msg = START + data + crc + END
-        self.__ser.write(msg)
-        self.__do_response(VarId.WSPR_txFreq)
-        return self.__reply
+        return self.read_var(VarId.WSPR_txFreq)
+    
+    #----------------------------------------------
+    # Get any config variable
+    def read_var(self, var):
+        # msg = START/8 + READ/16 + VarId/16 + CRC/32 + STOP/8
+        return self.__cached_read(var)
+    
+    #----------------------------------------------
+    # Get every config variable
+    # Returns (True, {name : value}), value is None if the read failed
+    def read_all(self, depth = READ_ALL_DEPTH):
+        return self.__submit(self.__read_all, depth)
     
     #----------------------------------------------
     # Write methods
@@ -404,45 +773,36 @@ class WSPRLite(object):
     # Set the transmit frequency
     # Freq is a float. This needs to be a 64 bit byte array in LE
     def set_freq(self, freq):
+        if not _is_number(freq) or not 0 <= freq*1000000 < 2**64:
+            return _failed('Invalid frequency [%s]!' % str(freq))
         f = int(freq*1000000)
-        f_bytes = struct.pack('<Q', f)
-        f_bytes = self.__esc(f_bytes)
-        # msg = START/8 + WRITE/16 + WSPR_txFreq/16 + CRC/32 + STOP/8
-        data = MsgType.Write.value + VarId.WSPR_txFreq.value + f_bytes
-        crc = self.calc_crc_32(data)
-        msg = START + data + crc + END
-        self.__ser.write(msg)
-        self.__do_response(VarId.WSPR_txFreq)
-        return self.__reply
+        return self.__submit(self.__write_var, VarId.WSPR_txFreq, build_freq_frame(f), f)
     
     # Set a transmit frequency given a band
     # Band is an integer wavelength.
     def set_band(self, band):
+        if not isinstance(band, int) or band not in freq_table.band_lookup:
+            return _failed('Invalid band [%s]!' % str(band))
         freq = freq_table.get_tx_freq(band)
-        f = int(freq*1000000)
-        f_bytes = struct.pack('<Q', f)
-        f_bytes = self.__esc(f_bytes)
-        # msg = START/8 + WRITE/16 + WSPR_txFreq/16 + CRC/32 + STOP/8
-        data = MsgType.Write.value + VarId.WSPR_txFreq.value + f_bytes
-        crc = self.calc_crc_32(data)
-        msg = START + data + crc + END
-        self.__ser.write(msg)
-        self.__do_response(VarId.WSPR_txFreq)
-        if self.__reply[0] == True:
-            return self.get_freq()
-        else:
-            return self.__reply
+        return self.__submit(self.__set_band, build_freq_frame(int(freq*1000000)))
+    
+    #----------------------------------------------
+    # Set any config variable
+    def write_var(self, var, value):
+        try:
+            data = var_codecs[var].encode(value)
+        except (ValueError, TypeError, struct.error) as e:
+            return _failed('Invalid value for %s [%s]' % (var.name, str(e)))
+        # msg = START/8 + WRITE/16 + VarId/16 + DATA + CRC/32 + STOP/8
+        msg = build_frame(MsgType.Write.value, var.value, data)
+        return self.__submit(self.__write_var, var, msg, value)
 
     #----------------------------------------------
     # Start transmitting
     # Note this must be correctly timed to an accurate clock
     def set_tx(self):
-        # msg = START/8 + MsgType.DeviceMode_Set/16 + DeviceMode.WSPR_Active/16 + CRC/32 + STOP/8
         if self.__status == IDLE:
-            data = MsgType.DeviceMode_Set.value + DeviceMode.WSPR_Active.value
-            crc = self.calc_crc_32(data)
-            self.__set_tx_msg = START + data + crc + END
-            self.__status = WAIT_START
+            self.__set_status(WAIT_START)
             print("Waiting for even minute to start TX...")
             self.__timer.wait_start()
             self.__m_start_cb((True, ''))
@@ -451,24 +811,138 @@ class WSPRLite(object):
     # Stop transmitting
     # Note this should be done immediately after a transmission, not during tramsmission
     def set_idle(self):
-        # msg = START/8 + MsgType.Reset/16 + CRC/32 + STOP/8
         if self.__status == TX_CYCLING:
-            data = MsgType.Reset.value
-            crc = self.calc_crc_32(data)
-            self.__idle_msg = START + data + crc + END
-            self.__status = WAIT_STOP
+            self.__set_status(WAIT_STOP)
             print("Waiting for just before next even minute to stop TX...")
             self.__timer.wait_stop()
             self.__m_stop_cb((True, ''))
         else:
             self.__timer.cancel()
-            self.__status = IDLE
+            self.__set_status(IDLE)
+    
+    #----------------------------------------------
+    # Planned TX campaigns
+    #----------------------------------------------
+    # Load a plan replacing any current plan
+    # Slots are UTC epoch times, each selects the 2 minute WSPR slot it falls in.
+    # Consecutive slots are run as one period of TX cycling.
+    # TX in progress carries on, the new plan takes over at its slots.
+    def load_plan(self, slots):
+        if not isinstance(slots, (list, tuple)) or not all(_is_number(t) for t in slots):
+            return (False, 'Slots must be a list of UTC times!')
+        self.__cancel_events()
+        now = time.time()
+        starts = sorted(set(timer.slot_start(t) for t in slots))
+        starts = [t for t in starts if t >= now]
+        events = []
+        n = 0
+        while n < len(starts):
+            # Find the end of this run of consecutive slots
+            first = n
+            while n + 1 < len(starts) and starts[n + 1] == starts[n] + timer.CYCLE:
+                n += 1
+            stop = starts[n] - timer.START_OFFSET + timer.STOP_OFFSET
+            events.append(self.__scheduler.schedule(starts[first], self.__plan_start))
+            events.append(self.__scheduler.schedule(stop, self.__plan_stop))
+            n += 1
+        self.__plan_events = events
+        return (True, len(starts))
+    
+    #----------------------------------------------
+    # Cancel the current plan
+    # If the plan started TX it stops at the next stop window, TX started
+    # by hand or by band hopping carries on
+    def cancel_plan(self):
+        self.__cancel_events()
+        if self.__plan_active and self.__status == TX_CYCLING:
+            self.set_idle()
+        return (True, '')
+    
+    #----------------------------------------------
+    # Remove the plan events from the scheduler
+    def __cancel_events(self):
+        for event in self.__plan_events:
+            self.__scheduler.cancel(event)
+        self.__plan_events = []
+    
+    #----------------------------------------------
+    # Plan status
+    # Returns (True, (pending events, UTC time of next event or None))
+    def get_plan(self):
+        return (True, (self.__scheduler.pending(), self.__scheduler.next_event()))
+    
+    #----------------------------------------------
+    # Band hopping
+    #----------------------------------------------
+    # Rotate through the given bands, one band per WSPR slot
+    # The frequency for the next band is written in the gap after each
+    # transmission so no slot is lost to the change. The first band is
+    # written now if idle, otherwise in the gap after the current
+    # transmission. TX cycling is started at the next slot if idle.
+    def start_hop(self, bands):
+        if not isinstance(bands, (list, tuple)):
+            return (False, 'Bands must be a list!')
+        for band in bands:
+            if not isinstance(band, int) or band not in freq_table.band_lookup:
+                return (False, 'Invalid band [%s]!' % str(band))
+        if len(bands) == 0:
+            return (False, 'No bands given!')
+        self.stop_hop()
+        self.__hop_bands = list(bands)
+        self.__hop_index = 0
+        self.__hop_stats = {'slots' : 0, 'hops' : 0, 'failed' : 0, 'start' : time.time()}
+        now = time.time()
+        if self.__status == IDLE:
+            self.__hop_write()
+        else:
+            # Not during a transmission, that would spoil the slot
+            self.__hop_first_event = self.__scheduler.schedule(max(now, timer.slot_start(now) - timer.START_OFFSET + timer.GAP_OFFSET), self.__hop_write)
+        # Start in the next slot
+        first = timer.next_start(now)
+        self.__hop_start_event = self.__scheduler.schedule(first, self.__cycle_start)
+        self.__hop_event = self.__scheduler.schedule(first - timer.START_OFFSET + timer.GAP_OFFSET, self.__hop)
+        return (True, '')
+    
+    #----------------------------------------------
+    # Stop rotating bands, TX continues on the current band
+    def stop_hop(self):
+        if self.__hop_start_event != None:
+            self.__scheduler.cancel(self.__hop_start_event)
+            self.__hop_start_event = None
+        if self.__hop_first_event != None:
+            self.__scheduler.cancel(self.__hop_first_event)
+            self.__hop_first_event = None
+        if self.__hop_event != None:
+            self.__scheduler.cancel(self.__hop_event)
+            self.__hop_event = None
+        return (True, '')
+    
+    #----------------------------------------------
+    # Band hopping statistics
+    # Returns (True, {bands, band, slots, hops, failed, slots_per_hour})
+    # where slots counts the slots transmitted while hopping and hops and
+    # failed count the band writes, the first band included
+    def get_hop(self):
+        if self.__hop_stats == None:
+            return (False, 'Band hopping has not been started!')
+        stats = dict(self.__hop_stats)
+        hours = (time.time() - stats.pop('start'))/3600.0
+        stats['bands'] = self.__hop_bands
+        stats['band'] = self.__hop_bands[self.__hop_index]
+        stats['active'] = self.__hop_event != None
+        stats['slots_per_hour'] = stats['slots']/hours if hours > 0 else 0.0
+        return (True, stats)
     
     #----------------------------------------------
     # Get TX status
     def get_status(self):
         return (True, self.__status)
     
+    #----------------------------------------------
+    # Discard cached config so the next reads go to the device
+    def invalidate_cache(self):
+        self.__cache.clear()
+    
     #----------------------------------------------
     # Util methods
     #----------------------------------------------
@@ -477,154 +951,355 @@ class WSPRLite(object):
         return struct.pack('<I', binascii.crc32(data))       
 
     #----------------------------------------------
-    # Decode response
-    def __do_response(self, cmd):
+    # Queue work for the serial thread through the connection guard
+    def __submit(self, fn, *args, priority = worker.PRIORITY_NORMAL):
+        return self.__worker.submit(self.__guarded, fn, args, priority=priority)
+    
+    #----------------------------------------------
+    # Answer a read from the cache if the entry is fresh enough, else
+    # queue a read from the device
+    def __cached_read(self, var):
+        entry = self.__cache.get(var)
+        if entry != None:
+            if self.__cache_max_age == None or monotonic() - entry[1] < self.__cache_max_age:
+                future = Future()
+                future.set_result((True, entry[0]))
+                return future
+        return self.__submit(self.__read_var, var)
+    
+    #----------------------------------------------
+    # Change the TX status and notify
+    def __set_status(self, status):
+        changed = status != self.__status
+        self.__status = status
+        if status == IDLE:
+            # However TX stopped the plan no longer owns it
+            self.__plan_active = False
+        if changed and self.__m_change_cb != None:
+            self.__m_change_cb(GET_STATUS, status)
+    
+    #----------------------------------------------
+    # Cache a variable value, notify if a watched variable changed
+    def __cache_value(self, var, value):
+        old = self.__cache.get(var)
+        self.__cache[var] = (value, monotonic())
+        if var in watched_vars and self.__m_change_cb != None and (old == None or old[0] != value):
+            self.__m_change_cb(watched_vars[var], value)
+    
+    #----------------------------------------------
+    # Serial thread methods
+    #----------------------------------------------
+    # Run work if the device is connected, a serial error means it has gone
+    def __guarded(self, fn, args):
+        if self.__ser == None:
+            # Remember TX starting or stopping for when the device is back
+            if fn == self.__start_tx:
+                self.__resume_tx = True
+                self.__set_status(IDLE)
+            elif fn == self.__stop_tx:
+                self.__resume_tx = False
+                self.__set_status(IDLE)
+            return (False, 'Device not connected!')
+        try:
+            return fn(*args)
+        except PORT_ERRORS as e:
+            self.__lost(str(e))
+            return (False, 'Device disconnected!')
+    
+    #----------------------------------------------
+    # Close the port after the device has gone
+    def __lost(self, reason):
+        if self.__ser == None:
+            return
+        print("Lost device on %s [%s]" % (self.__port, reason))
+        try:
+            self.__ser.close()
+        except Exception:
+            pass
+        self.__ser = None
+        self.__lost_at = monotonic()
+        self.__link_stats['disconnects'] += 1
+        if self.__status == TX_CYCLING:
+            # The device stops when unplugged
+            self.__resume_tx = True
+            self.__set_status(IDLE)
+    
+    #----------------------------------------------
+    # Open the port, check it is the device and restore it
+    def __connect(self, port):
+        if self.__ser != None:
+            return (True, 0.0)
+        try:
+            self.__ser = open_port(port)
+        except serial.SerialException as e:
+            return (False, str(e))
+        self.__port = port
+        restore_start = monotonic()
+        try:
+            reply = self.__identify()
+            if reply[0] == True:
+                self.__restore()
+        except PORT_ERRORS as e:
+            reply = (False, str(e))
+        if reply[0] == False:
+            # Not usable yet, still lost since the original time
+            try:
+                self.__ser.close()
+            except Exception:
+                pass
+            self.__ser = None
+            return reply
+        now = monotonic()
+        recovery = now - self.__lost_at
+        stats = self.__link_stats
+        stats['reconnects'] += 1
+        stats['last_recovery'] = recovery
+        stats['max_recovery'] = recovery if stats['max_recovery'] == None else max(stats['max_recovery'], recovery)
+        stats['last_restore'] = now - restore_start
+        RECOVERY.observe(recovery, port)
+        print("Device ready on %s after %.3fs" % (port, recovery))
+        if self.__resume_tx and self.__status == IDLE:
+            self.__resume_tx = False
+            self.__set_status(WAIT_START)
+            self.__timer.wait_start()
+            self.__m_start_cb((True, ''))
+        return (True, recovery)
+    
+    #----------------------------------------------
+    # Read the DeviceId
+    # A different device loses the cached config, and the config written to
+    # and the TX state of the old device are not restored onto it
+    def __identify(self):
+        reply = self.__exchange(read_frames[VarId.DeviceId], VarId.DeviceId)
+        if reply[0] == True:
+            if self.__device_id != None and reply[1] != self.__device_id:
+                print("DeviceId %d on %s, expected %d, not restoring" % (reply[1], self.__port, self.__device_id))
+                self.__cache.clear()
+                self.__written.clear()
+                self.__resume_tx = False
+            self.__device_id = reply[1]
+        return reply
+    
+    #----------------------------------------------
+    # Write again every variable written through the server
+    def __restore(self):
+        for var, value in list(self.__written.items()):
+            reply = self.__exchange(build_frame(MsgType.Write.value, var.value, var_codecs[var].encode(value)), var)
+            if reply[0] == True:
+                self.__cache_value(var, value)
+            else:
+                print("Failed to restore %s [%s]" % (var.name, reply[1]))
+    
+    # Execute one command/response exchange
+    def __exchange(self, msg, cmd):
+        start = monotonic()
+        self.__send(msg)
         # Responses are variable length and depend on the request type
-        # Process response data
-        self.__state = State.IDLE
-        self.__reply = (False, '')
-        while True:
-            if self.__state == State.IDLE: self.__do_idle()
-            elif self.__state == State.START: self.__do_start()
-            elif self.__state == State.ESC: self.__do_esc()
-            elif self.__state == State.ACK: self.__do_ack()
-            elif self.__state == State.NACK: self.__do_nack()
-            elif self.__state == State.RESP: self.__do_resp()
-            elif self.__state == State.DATA: self.__do_data(cmd)
-            elif self.__state == State.CS: self.__do_cs()
-            elif self.__state == State.END: self.__do_end()
-            elif self.__state == State.DONE: break
-
-    #----------------------------------------------
-    def __do_idle(self):
-        # Wait for msg start
-        b = self.__ser.read(1)
-        if b == b'\x01':
-            # We have message start
-            self.__state = State.START
-        elif b == b'':
-            # Lite did not respons so probably missed the command
+        response = self.__read_message()
+        self.__record(msg_type_lookup.get(msg[1:3]), cmd, response, monotonic() - start)
+        return self.__decode_response(response, cmd)
+    
+    #----------------------------------------------
+    # Update the serial metrics for an exchange, rtt None if not known
+    def __record(self, type, cmd, response, rtt):
+        labels = (self.__port, 'Unknown' if type == None else type.name, cmd.name)
+        if response == None:
+            SERIAL_TIMEOUTS.inc(*labels)
+            return
+        if rtt != None:
+            SERIAL_RTT.observe(rtt, *labels)
+        if response.type == MsgType.NACK:
+            SERIAL_NACKS.inc(*labels)
+    
+    #----------------------------------------------
+    # Read a variable and cache the value
+    def __read_var(self, var):
+        reply = self.__exchange(read_frames[var], var)
+        if reply[0] == True:
+            self.__cache_value(var, reply[1])
+        else:
+            self.__cache.pop(var, None)
+        return reply
+    
+    #----------------------------------------------
+    # Write a variable and cache the value written
+    def __write_var(self, var, msg, value):
+        reply = self.__exchange(msg, var)
+        if reply[0] == True:
+            self.__written[var] = value
+            self.__cache_value(var, value)
+        else:
+            self.__cache.pop(var, None)
+        return reply
+    
+    #----------------------------------------------
+    # Read all variables keeping up to depth reads outstanding
+    # The device answers in order so responses are matched by position.
+    # If the device stops answering the reads still outstanding are
+    # retried one at a time.
+    def __read_all(self, depth):
+        snapshot = {}
+        todo = deque(var_codecs)
+        pending = deque()
+        self.__reset_input()
+        while len(todo) > 0 or len(pending) > 0:
+            while len(todo) > 0 and len(pending) < depth:
+                var = todo.popleft()
+                self.__ser.write(read_frames[var])
+                pending.append(var)
+            var = pending.popleft()
+            msg = self.__read_message()
+            # Pipelined so there is no round trip time for one read
+            self.__record(MsgType.Read, var, msg, None)
+            if msg == None and depth > 1:
+                # Lost track, fall back to one at a time
+                todo.extendleft(reversed(pending))
+                todo.appendleft(var)
+                pending.clear()
+                depth = 1
+                self.__reset_input()
+                continue
+            reply = self.__decode_response(msg, var)
+            if reply[0] == True:
+                self.__cache_value(var, reply[1])
+                snapshot[var.name] = reply[1]
+            else:
+                snapshot[var.name] = None
+        return (True, snapshot)
+    
+    #----------------------------------------------
+    # Write the band frequency and read back the frequency set
+    def __set_band(self, msg):
+        reply = self.__exchange(msg, VarId.WSPR_txFreq)
+        if reply[0] == True:
+            reply = self.__read_var(VarId.WSPR_txFreq)
+            if reply[0] == True:
+                self.__written[VarId.WSPR_txFreq] = reply[1]
+            return reply
+        else:
+            self.__cache.pop(VarId.WSPR_txFreq, None)
+            return reply
+    
+    #----------------------------------------------
+    # Convert a response message to a reply
+    def __decode_response(self, msg, cmd):
+        if msg == None:
+            # Lite did not respond so probably missed the command
             # For now lets terminate this exchange.
-            self.__state = State.DONE
-            self.__reply = (False, 'Command failed!')
-    
-    #----------------------------------------------    
-    def __do_start(self):
-        # Read next byte
-        b = self.__ser.read(1)
-        if b == b'\x10':
-            # Start of escape sequence
-            self.__state = State.ESC
-        elif  b == b'\x02':
-            # We have an ACK
-            # Its a 16 bit number
-            self.__ser.read(1)
-            self.__state = State.ACK
-    
-    #----------------------------------------------         
-    def __do_esc(self):
-        # Read next byte
-        b = self.__ser.read(1)
-        if b == b'\x81':
-            # We have a NAK
-            self.__ser.read(1)
-            self.__state = State.NACK
-        elif  b == b'\x84':
-            # We have a RESPONSE
-            self.__ser.read(1)
-            self.__state = State.RESP
-    
-    #----------------------------------------------          
-    def __do_ack(self):
-        self.__reply = (True, '')
-        self.__state = State.CS
-    
-    #----------------------------------------------      
-    def __do_nack(self):
-        self.__reply = (False, 'Command returned NACK!')
-        self.__state = State.CS
-    
-    #----------------------------------------------      
-    def __do_resp(self):
-        # We now expect some response data
-        # The length of this depends on the command
-        self.__state = State.DATA
+            return (False, 'Command failed!')
+        elif not msg.valid:
+            return (False, 'Checksum error!')
+        elif msg.type == MsgType.ACK:
+            return (True, '')
+        elif msg.type == MsgType.NACK:
+            return (False, 'Command returned NACK!')
+        elif msg.type == MsgType.ResponseData and cmd in var_codecs:
+            # Decode the data according to the variable type
+            return (True, var_codecs[cmd].decode(msg.data))
+        else:
+            return (False, 'Unexpected response!')
     
-    #----------------------------------------------   
-    def __do_data(self, cmd):
-        # Decode the data according to the command type
-        if cmd == VarId.WSPR_callsign:
-            len = data_def[VarId.WSPR_callsign]
-            data = self.__ser.read(len)
-            self.__reply = (True, data.decode("ascii").rstrip('\0'))
-            self.__state = State.CS
-        elif cmd == VarId.WSPR_locator:
-            len = data_def[VarId.WSPR_locator]
-            data = self.__ser.read(len)
-            self.__reply = (True, data.decode("ascii").rstrip('\0'))
-            self.__state = State.CS            
-        elif cmd == VarId.WSPR_txFreq:
-            len = data_def[VarId.WSPR_txFreq]
-            data = self.__ser.read(len)
-            data = self.__unesc(data)
-            self.__reply = (True, struct.unpack('<Q',data)[0])
-            self.__state = State.CS
-            
-    #----------------------------------------------     
-    def __do_cs(self):
-        # Should check this
-        self.__ser.read(4)
-        self.__state = State.END
-    
-    #----------------------------------------------      
-    def __do_end(self):
-        # Wait for msg end
-        b = self.__ser.read(1)
-        if b == b'\x04':
-            # We have message end
-            self.__state = State.DONE
-
-    #----------------------------------------------
-    # Escape any control bytes
-    def __esc(self, f_bytes):
-        ba = bytearray(len(f_bytes))
-        n = 0
-        for b in f_bytes:
-            if b == 0x01 or b == 0x04:
-                b = b | 0x80
-            ba[n] = b
-            n += 1
-        return bytes(ba)
+    #----------------------------------------------
+    # Read until a complete message is decoded
+    def __read_message(self):
+        # Several messages may arrive together when reads are pipelined
+        while len(self.__msgs) == 0:
+            # Take everything waiting, or block for at least one byte
+            data = self.__ser.read(self.__ser.in_waiting or 1)
+            if data == b'':
+                # Timeout
+                return None
+            self.__msgs.extend(self.__decoder.feed(data))
+        return self.__msgs.popleft()
     
     #----------------------------------------------
-    # Escape any control bytes
-    def __unesc(self, f_bytes):
-        ba = bytearray(len(f_bytes))
-        n = 0
-        for b in f_bytes:
-            if b == 0x81 or b == 0x84:
-                b = b & 0x05
-            ba[n] = b
-            n += 1
-        return bytes(ba)
+    # Discard any stale response data
+    def __reset_input(self):
+        self.__ser.reset_input_buffer()
+        self.__decoder.reset()
+        self.__msgs.clear()
     
+    #----------------------------------------------
+    # Send a message discarding any stale response data
+    def __send(self, msg):
+        self.__reset_input()
+        self.__ser.write(msg)
+
     #========================================================================
     # Callbacks
+    # These run on the timer thread so hand the exchange to the serial
+    # thread ahead of any queued requests
     def __start_cb(self):
+        self.__submit(self.__start_tx, priority=worker.PRIORITY_TX)
+    
+    #----------------------------------------------   
+    def __stop_cb(self):
+        self.__submit(self.__stop_tx, priority=worker.PRIORITY_TX)
+    
+    #----------------------------------------------   
+    # Plan events run on the scheduler thread at the slot times
+    def __plan_start(self):
+        if self.__cycle_start():
+            self.__plan_active = True
+    
+    #----------------------------------------------   
+    # Only stops TX the plan started
+    def __plan_stop(self):
+        if self.__plan_active and self.__status == TX_CYCLING:
+            self.__set_status(WAIT_STOP)
+            self.__stop_cb()
+            self.__m_stop_cb((True, ''))
+    
+    #----------------------------------------------   
+    # Start TX cycling now if idle, returns True if started
+    def __cycle_start(self):
+        if self.__status == IDLE:
+            self.__set_status(WAIT_START)
+            self.__start_cb()
+            self.__m_start_cb((True, ''))
+            return True
+        return False
+    
+    #----------------------------------------------   
+    # Band hop event, runs on the scheduler thread in the gap after a transmission
+    def __hop(self):
+        if self.__status == TX_CYCLING:
+            self.__hop_stats['slots'] += 1
+        self.__hop_index = (self.__hop_index + 1) % len(self.__hop_bands)
+        self.__hop_write()
+        self.__hop_event = self.__scheduler.schedule(timer.slot_start(time.time()) - timer.START_OFFSET + timer.CYCLE + timer.GAP_OFFSET, self.__hop)
+    
+    #----------------------------------------------   
+    # Write the frequency for the current hop band, counted in the hop statistics
+    def __hop_write(self):
+        msg = build_freq_frame(int(freq_table.get_tx_freq(self.__hop_bands[self.__hop_index])*1000000))
+        # The write must complete before the next slot so it goes ahead of queued requests
+        self.__submit(self.__set_band, msg, priority=worker.PRIORITY_TX).add_done_callback(self.__hop_done)
+    
+    #----------------------------------------------   
+    def __hop_done(self, future):
+        if future.exception() == None and future.result()[0] == True:
+            self.__hop_stats['hops'] += 1
+        else:
+            self.__hop_stats['failed'] += 1
+    
+    #----------------------------------------------   
+    def __start_tx(self):
         # Complete the TX message at correct start time
-        self.__ser.write(self.__set_tx_msg)
-        self.__do_response(DeviceMode.WSPR_Active)
-        print("Delayed response from start TX: ", self.__reply)
-        self.__status = TX_CYCLING
+        reply = self.__exchange(SET_TX_FRAME, DeviceMode.WSPR_Active)
+        if reply[0] == True:
+            # Offset from the nearest even minute
+            TX_START_OFFSET.observe((time.time() + timer.CYCLE/2) % timer.CYCLE - timer.CYCLE/2, self.__port)
+        print("Delayed response from start TX: ", reply)
+        self.__set_status(TX_CYCLING)
         print("Starting TX cycling...")
     
     #----------------------------------------------   
-    def __stop_cb(self):
+    def __stop_tx(self):
         # Complete the reset message during transmission window
-        self.__ser.write(self.__idle_msg)
-        self.__do_response(MsgType.Reset)
-        print("Delayed response from stop TX: ", self.__reply)
-        self.__status = IDLE
+        reply = self.__exchange(RESET_FRAME, MsgType.Reset)
+        print("Delayed response from stop TX: ", reply)
+        self.__set_status(IDLE)
         print("Stopped TX cycling...")
         
 #========================================================================
@@ -638,11 +1313,11 @@ if __name__ == '__main__':
         device = '/dev/ttyUSB0'
     
     lite = WSPRLite(device)
-    print(lite.get_callsign())
-    print(lite.get_locator())
-    print(lite.get_freq())
-    print(lite.set_freq(14.097066))
-    print(lite.get_freq())
+    print(lite.get_callsign().result())
+    print(lite.get_locator().result())
+    print(lite.get_freq().result())
+    print(lite.set_freq(14.097066).result())
+    print(lite.get_freq().result())
     print(lite.set_tx())
     sleep(3)
     print(lite.set_idle())
\ No newline at end of file
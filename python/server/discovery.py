@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+#
+# discovery.py
+#
+# Copyright (C) 2019 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    Discovery of WSPRLites on the serial ports.
+
+    Candidate ports are those with the USB description WSPRLITE_DESCRIPTION.
+    Each candidate is opened and sent a Version message, a WSPRLite answers
+    with its device and firmware version. The DeviceId is read as well so a
+    device is recognised whichever port it comes back on. Ports are probed
+    in parallel so a scan takes one probe however many ports there are.
+
+    pyserial has no hot-plug events so the Watcher thread polls. Every
+    DISCOVERY_INTERVAL it disconnects devices whose port has gone and, while
+    any device is disconnected, probes the free candidate ports and the
+    ports the missing devices were on and reconnects them.
+"""
+
+# Python imports
+import os, sys
+import threading
+import struct
+from concurrent.futures import ThreadPoolExecutor
+import serial
+from serial.tools import list_ports
+
+# Application imports
+sys.path.append('..')
+from common.defs import *
+from device import *
+
+# Version reply, productId productRevision bootloaderVersion major minor patch date
+VERSION = struct.Struct('<7I')
+
+#----------------------------------------------
+# Ports with the WSPRLite USB description
+def candidates():
+    ports = []
+    for info in list_ports.comports():
+        if WSPRLITE_DESCRIPTION in (info.description or '') or WSPRLITE_DESCRIPTION in (info.product or ''):
+            ports.append(info.device)
+    return ports
+
+#----------------------------------------------
+# Ask a port what is on it
+def probe(port, timeout = PROBE_TIMEOUT):
+    """
+    Probe a port for a WSPRLite
+
+    Arguments:
+        port    --  serial port
+        timeout --  seconds to wait for each response
+
+    Returns {'port', 'version', 'device_id'} or None if there is no
+    WSPRLite on the port. version is the 7 numbers of the Version reply.
+    """
+
+    try:
+        ser = open_port(port, timeout)
+    except serial.SerialException:
+        return None
+    try:
+        decoder = FrameDecoder()
+        replies = []
+        for frame in (VERSION_FRAME, read_frames[VarId.DeviceId]):
+            ser.reset_input_buffer()
+            ser.write(frame)
+            msgs = []
+            while len(msgs) == 0:
+                data = ser.read(ser.in_waiting or 1)
+                if data == b'':
+                    return None
+                msgs = decoder.feed(data)
+            if not msgs[0].valid or msgs[0].type != MsgType.ResponseData:
+                return None
+            replies.append(msgs[0].data)
+        if len(replies[0]) < VERSION.size:
+            return None
+        return {'port' : port, 'version' : VERSION.unpack_from(replies[0]), 'device_id' : var_codecs[VarId.DeviceId].decode(replies[1])}
+    except PORT_ERRORS:
+        return None
+    finally:
+        ser.close()
+
+#----------------------------------------------
+# Probe ports in parallel
+def scan(ports = None, timeout = PROBE_TIMEOUT):
+    """
+    Find WSPRLites
+
+    Arguments:
+        ports   --  ports to probe, default candidates()
+        timeout --  seconds to wait for each response
+
+    Returns a list of probe() results ordered by DeviceId
+    """
+
+    if ports == None:
+        ports = candidates()
+    if len(ports) == 0:
+        return []
+    with ThreadPoolExecutor(len(ports)) as pool:
+        found = [r for r in pool.map(lambda port: probe(port, timeout), ports) if r != None]
+    return sorted(found, key=lambda r: r['device_id'])
+
+#========================================================================
+"""
+    Hot-plug watcher
+"""
+class Watcher(threading.Thread):
+
+    #----------------------------------------------
+    # Constructor
+    def __init__(self, lites, interval = DISCOVERY_INTERVAL):
+        """
+        Constructor
+
+        Arguments:
+            lites       --  device id : WSPRLite
+            interval    --  seconds between scans
+
+        """
+
+        super(Watcher, self).__init__()
+
+        self.__lites = lites
+        self.__interval = interval
+        self.__terminate = threading.Event()
+
+    #----------------------------------------------
+    # Terminate
+    def terminate(self):
+        """
+            Terminate thread
+        """
+        self.__terminate.set()
+
+    #----------------------------------------------
+    # Entry point
+    def run(self):
+        """
+            Scan until terminated
+        """
+        while not self.__terminate.wait(self.__interval):
+            try:
+                self.__check()
+            except Exception as e:
+                print('Exception in device discovery [%s]' % str(e))
+
+    #----------------------------------------------
+    # One scan
+    def __check(self):
+        missing = []
+        in_use = set()
+        for lite in self.__lites.values():
+            if not lite.connected():
+                missing.append(lite)
+            elif self.__gone(lite.port()):
+                lite.disconnect()
+                missing.append(lite)
+            else:
+                in_use.add(lite.port())
+        if len(missing) == 0:
+            return
+        ports = set(candidates())
+        ports.update(lite.port() for lite in missing)
+        ports = [port for port in ports if port not in in_use and not self.__gone(port)]
+        for found in scan(ports):
+            lite = self.__match(found, missing)
+            if lite != None:
+                missing.remove(lite)
+                lite.connect(found['port'])
+
+    #----------------------------------------------
+    # The device for a port that answered
+    # The same DeviceId first, then the device last on the port, which may
+    # have been swapped, then one that has never answered. Only a matching
+    # DeviceId has its config and TX state restored, see WSPRLite.connect()
+    def __match(self, found, missing):
+        for lite in missing:
+            if lite.device_id() == found['device_id']:
+                return lite
+        for lite in missing:
+            if lite.port() == found['port']:
+                return lite
+        for lite in missing:
+            if lite.device_id() == None:
+                return lite
+        return None
+
+    #----------------------------------------------
+    # True if a port has been removed
+    # Windows COM ports are not files so only a failed exchange shows they have gone
+    def __gone(self, port):
+        if sys.platform == 'win32' or sys.platform == 'win64':
+            return False
+        return not os.path.exists(port)
+
+#========================================================================
+# List the WSPRLites attached
+if __name__ == '__main__':
+
+    for found in scan():
+        print('%s DeviceId %d version %s' % (found['port'], found['device_id'], '.'.join(str(v) for v in found['version'][3:6])))
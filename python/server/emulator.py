@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+#
+# emulator.py
+#
+# Copyright (C) 2019 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    WSPRLite device emulator.
+
+    Opens a pseudo-terminal and answers on the master side using the message
+    format in device.py. The slave side is a serial port that device.WSPRLite
+    can open in place of /dev/ttyUSB0, so the server can be run and load
+    tested with no hardware attached. Linux only.
+
+    Supported messages are Version, Read, Write, Reset, DeviceMode_Get,
+    DeviceMode_Set and WSPR_GetTime. Anything else gets a NACK.
+
+    Faults can be injected at a given rate (0.0 - 1.0):
+        drop    --  no response at all
+        nack    --  respond with NACK
+        corrupt --  respond with a bad checksum
+        noise   --  send line noise before the response
+        split   --  send the response in two writes with a pause between
+"""
+
+# Python imports
+import os, sys
+import threading
+import select
+import struct
+import binascii
+import random
+import tty
+import argparse
+from time import sleep, monotonic
+
+# Application imports
+sys.path.append('..')
+from common.defs import *
+from device import *
+
+# Fault types
+FAULTS = ('drop', 'nack', 'corrupt', 'noise', 'split')
+
+# Version reply, productId productRevision bootloaderVersion major minor patch date
+VERSION = (1, 1, 1, 1, 1, 1, 20190101)
+
+# Default config
+DEFAULT_CONFIG = {
+    VarId.MemVersion : 1,
+    VarId.xoFreq : 25000000,
+    VarId.xoFreqFactory : 25000000,
+    VarId.ChangeCounter : 0,
+    VarId.DeviceId : 1,
+    VarId.DeviceSecret : 0,
+    VarId.WSPR_txFreq : 14097100,
+    VarId.WSPR_locator : 'IO91',
+    VarId.WSPR_callsign : 'G3UKB',
+    VarId.WSPR_paBias : 500,
+    VarId.WSPR_outputPower : 200,
+    VarId.WSPR_reportPower : 23,
+    VarId.WSPR_txPct : 20,
+    VarId.WSPR_maxTxDuration : 0,
+    VarId.CwId_Freq : 0,
+    VarId.CwId_Callsign : '',
+    VarId.PaBiasSource : 0,
+}
+
+#========================================================================
+"""
+    Emulated WSPRLite on a pseudo-terminal
+"""
+class Emulator(threading.Thread):
+
+    #----------------------------------------------
+    # Constructor
+    def __init__(self, latency = 0.0, faults = None, config = None, seed = None):
+        """
+        Constructor
+
+        Arguments
+            latency --  seconds to wait before each response
+            faults  --  {fault : rate} see FAULTS
+            config  --  {VarId : value} to override the default config
+            seed    --  random seed for repeatable fault injection
+        """
+
+        super(Emulator, self).__init__()
+        self.daemon = True
+
+        self.__latency = latency
+        self.__faults = {}
+        if faults != None:
+            for fault, rate in faults.items():
+                if fault not in FAULTS:
+                    raise ValueError('Unknown fault [%s]' % fault)
+                self.__faults[fault] = rate
+        self.__random = random.Random(seed)
+
+        # Config is held encoded as the device would return it
+        values = dict(DEFAULT_CONFIG)
+        if config != None:
+            values.update(config)
+        self.__store = {var : var_codecs[var].encode(value) for var, value in values.items()}
+
+        # Device state
+        self.__mode = DeviceMode.Init
+        self.__tx_start = None
+
+        # Statistics
+        self.__stats = {'messages' : 0}
+        for fault in FAULTS:
+            self.__stats[fault] = 0
+
+        # Keep our own handle on the slave so the master does not see a
+        # hangup when the client closes the port
+        self.__master, self.__slave = os.openpty()
+        tty.setraw(self.__master)
+        tty.setraw(self.__slave)
+        self.__port = os.ttyname(self.__slave)
+
+        self.__decoder = FrameDecoder()
+        self.__terminate = False
+
+    #----------------------------------------------
+    # Serial port to open to talk to the emulator
+    def port(self):
+        return self.__port
+
+    #----------------------------------------------
+    # Copy of the statistics
+    def stats(self):
+        return dict(self.__stats)
+
+    #----------------------------------------------
+    # Current config value
+    def get_var(self, var):
+        return var_codecs[var].decode(self.__store[var])
+
+    #----------------------------------------------
+    # Current device mode
+    def get_mode(self):
+        return self.__mode
+
+    #----------------------------------------------
+    # Terminate
+    def terminate(self):
+        """
+            Terminate thread
+        """
+        self.__terminate = True
+
+    #----------------------------------------------
+    # Entry point
+    def run(self):
+        """
+            Answer messages until terminated
+        """
+        while not self.__terminate:
+            r, w, x = select.select([self.__master], [], [], 0.5)
+            if len(r) == 0:
+                continue
+            try:
+                data = os.read(self.__master, 1024)
+            except OSError:
+                continue
+            for msg in self.__decoder.feed(data):
+                self.__stats['messages'] += 1
+                self.__respond(msg)
+        os.close(self.__master)
+        os.close(self.__slave)
+
+    #----------------------------------------------
+    # Send the response to a message
+    def __respond(self, msg):
+        if self.__latency > 0:
+            sleep(self.__latency)
+        if self.__inject('drop'):
+            return
+        if self.__inject('nack'):
+            response = self.__nack('Injected fault')
+        else:
+            response = self.__execute(msg)
+        crc = binascii.crc32(response)
+        if self.__inject('corrupt'):
+            crc ^= 0xffffffff
+        frame = START + escape(response + struct.pack('<I', crc)) + END
+        if self.__inject('noise'):
+            os.write(self.__master, bytes(self.__random.randrange(0x05, 0x10) for n in range(8)))
+        if self.__inject('split'):
+            n = len(frame) // 2
+            os.write(self.__master, frame[:n])
+            sleep(0.01)
+            frame = frame[n:]
+        os.write(self.__master, frame)
+
+    #----------------------------------------------
+    # Decide whether to inject a fault
+    def __inject(self, fault):
+        rate = self.__faults.get(fault, 0.0)
+        if rate > 0 and self.__random.random() < rate:
+            self.__stats[fault] += 1
+            return True
+        return False
+
+    #----------------------------------------------
+    # Execute a message and return the response msgType msgData
+    def __execute(self, msg):
+        if not msg.valid:
+            return self.__nack('Bad checksum')
+        if msg.type == MsgType.Version:
+            return b''.join((MsgType.ResponseData.value, struct.pack('<7I', *VERSION)))
+        elif msg.type == MsgType.Read:
+            var = self.__var(msg.data)
+            if var == None:
+                return self.__nack('Unknown variable')
+            return b''.join((MsgType.ResponseData.value, self.__store[var]))
+        elif msg.type == MsgType.Write:
+            var = self.__var(msg.data)
+            if var == None:
+                return self.__nack('Unknown variable')
+            try:
+                var_codecs[var].decode(msg.data[2:])
+            except (ValueError, UnicodeDecodeError):
+                return self.__nack('Invalid value')
+            self.__store[var] = msg.data[2:]
+            count = var_codecs[VarId.ChangeCounter].decode(self.__store[VarId.ChangeCounter])
+            self.__store[VarId.ChangeCounter] = var_codecs[VarId.ChangeCounter].encode(count + 1)
+            return MsgType.ACK.value
+        elif msg.type == MsgType.Reset:
+            self.__mode = DeviceMode.Init
+            self.__tx_start = None
+            return MsgType.ACK.value
+        elif msg.type == MsgType.DeviceMode_Get:
+            if self.__mode == DeviceMode.WSPR_Active:
+                return b''.join((MsgType.ResponseData.value, self.__mode.value, b'\x00\x00'))
+            return b''.join((MsgType.ResponseData.value, self.__mode.value))
+        elif msg.type == MsgType.DeviceMode_Set:
+            try:
+                mode = DeviceMode(msg.data[:2])
+            except ValueError:
+                return self.__nack('Invalid mode')
+            self.__mode = mode
+            if mode == DeviceMode.WSPR_Active:
+                self.__tx_start = monotonic()
+            else:
+                self.__tx_start = None
+            return MsgType.ACK.value
+        elif msg.type == MsgType.WSPR_GetTime:
+            elapsed = 0.0
+            if self.__tx_start != None:
+                elapsed = monotonic() - self.__tx_start
+            ms = int(elapsed * 1000)
+            return b''.join((MsgType.ResponseData.value,
+                struct.pack('<HBBI', ms % 1000, (ms // 1000) % 60, (ms // 60000) % 60, ms // 3600000)))
+        return self.__nack('Unsupported command')
+
+    #----------------------------------------------
+    # Config variable addressed by a Read/Write message
+    def __var(self, data):
+        try:
+            var = VarId(data[:2])
+        except ValueError:
+            return None
+        if var not in self.__store:
+            return None
+        return var
+
+    #----------------------------------------------
+    # NACK with an error message
+    def __nack(self, text):
+        return b''.join((MsgType.NACK.value, text.encode('ascii') + b'\0'))
+
+#========================================================================
+# Run an emulator until interrupted
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='WSPRLite emulator')
+    parser.add_argument('--latency', type=float, default=0.0, help='response latency in seconds')
+    parser.add_argument('--seed', type=int, default=None, help='random seed for fault injection')
+    for fault in FAULTS:
+        parser.add_argument('--' + fault, type=float, default=0.0, help='%s fault rate 0.0-1.0' % fault)
+    args = parser.parse_args()
+
+    emulator = Emulator(args.latency, {fault : getattr(args, fault) for fault in FAULTS}, seed=args.seed)
+    emulator.start()
+    print('WSPRLite emulator on %s' % emulator.port())
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        emulator.terminate()
+        emulator.join()
+        print(emulator.stats())
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+#
+# metrics.py
+#
+# Copyright (C) 2019 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    Metrics registry for the server.
+
+    Counters, gauges and histograms are registered by name with a help
+    string and label names as in the Prometheus data model. Each set of
+    label values is a series. An update is a dict lookup and an add under
+    the registry lock so they can be made from any thread.
+
+    tick() is called every METRICS_INTERVAL and works out the per second
+    rate of each counter series over the interval, so rates can be read
+    without a Prometheus server.
+
+    snapshot() returns the metrics as plain values for the GET_METRICS
+    request. Histograms are summarised as count, sum and estimated
+    quantiles to fit a datagram. prometheus() renders the text exposition
+    format with every bucket and write() puts it in a file for the node
+    exporter textfile collector.
+"""
+
+# Python imports
+import os, sys
+import threading
+from bisect import bisect_left
+from time import monotonic
+
+# Application imports
+sys.path.append('..')
+from common.defs import *
+
+# Quantiles estimated for snapshot()
+QUANTILES = (0.5, 0.95, 0.99)
+
+#========================================================================
+# Base of all metric types
+class Metric(object):
+
+    type = None
+
+    #----------------------------------------------
+    # Constructor
+    def __init__(self, registry, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = registry.lock
+        # Label values : series
+        self._series = {}
+
+    #----------------------------------------------
+    # Series for label values, lock held
+    def _get(self, values):
+        series = self._series.get(values)
+        if series == None:
+            if len(values) != len(self.labels):
+                raise ValueError('%s expects labels %s' % (self.name, str(self.labels)))
+            series = self._new()
+            self._series[values] = series
+        return series
+
+    #----------------------------------------------
+    # Copy of every series as (label values, value), lock held
+    def _items(self):
+        return list(self._series.items())
+
+#========================================================================
+# Count that only goes up
+class Counter(Metric):
+
+    type = 'counter'
+
+    def _new(self):
+        # [total, total at the last tick, rate over the last interval]
+        return [0, 0, 0.0]
+
+    #----------------------------------------------
+    # Add to the count
+    def inc(self, *values, n = 1):
+        with self._lock:
+            self._get(values)[0] += n
+
+    #----------------------------------------------
+    # Work out rates, lock held
+    def _tick(self, interval):
+        for series in self._series.values():
+            series[2] = (series[0] - series[1])/interval
+            series[1] = series[0]
+
+    def _value(self, series):
+        return {'total' : series[0], 'rate' : series[2]}
+
+    def _lines(self, labels, series):
+        return ['%s%s %s' % (self.name, _labels(self.labels, labels), _number(series[0]))]
+
+#========================================================================
+# Value that is set
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def _new(self):
+        return [0.0]
+
+    #----------------------------------------------
+    # Set the value
+    def set(self, value, *values):
+        with self._lock:
+            self._get(values)[0] = value
+
+    def _tick(self, interval):
+        pass
+
+    def _value(self, series):
+        return series[0]
+
+    def _lines(self, labels, series):
+        return ['%s%s %s' % (self.name, _labels(self.labels, labels), _number(series[0]))]
+
+#========================================================================
+# Distribution of observed values in fixed buckets
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    #----------------------------------------------
+    # Constructor
+    def __init__(self, registry, name, help, labels, buckets):
+        super(Histogram, self).__init__(registry, name, help, labels)
+        # Upper bounds, an observation goes in the first bucket >= it
+        self.buckets = tuple(sorted(buckets))
+
+    def _new(self):
+        # [count in each bucket and over the last, sum, count]
+        return [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+    #----------------------------------------------
+    # Record a value
+    def observe(self, value, *values):
+        with self._lock:
+            series = self._get(values)
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def _tick(self, interval):
+        pass
+
+    def _value(self, series):
+        value = {'count' : series[2], 'sum' : series[1]}
+        for q in QUANTILES:
+            value['p%d' % int(q*100)] = self.__quantile(series, q)
+        return value
+
+    #----------------------------------------------
+    # Estimate a quantile, interpolating within the bucket it falls in
+    # as Prometheus histogram_quantile() does
+    def __quantile(self, series, q):
+        if series[2] == 0:
+            return None
+        rank = q * series[2]
+        below = 0
+        for n, count in enumerate(series[0]):
+            if below + count >= rank and count > 0:
+                if n == len(self.buckets):
+                    # Over the last bound, the best answer is the bound
+                    return self.buckets[-1] if n > 0 else None
+                lower = self.buckets[n - 1] if n > 0 else min(0.0, self.buckets[0])
+                return lower + (self.buckets[n] - lower) * (rank - below)/count
+            below += count
+        return self.buckets[-1]
+
+    def _lines(self, labels, series):
+        lines = []
+        cumulative = 0
+        for n, bound in enumerate(self.buckets + (float('inf'),)):
+            cumulative += series[0][n]
+            lines.append('%s_bucket%s %d' % (self.name, _labels(self.labels + ('le',), labels + (_number(bound),)), cumulative))
+        lines.append('%s_sum%s %s' % (self.name, _labels(self.labels, labels), _number(series[1])))
+        lines.append('%s_count%s %d' % (self.name, _labels(self.labels, labels), series[2]))
+        return lines
+
+#========================================================================
+"""
+    Registry of metrics
+"""
+class Registry(object):
+
+    #----------------------------------------------
+    # Constructor
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Name : metric, in the order registered
+        self.__metrics = {}
+        self.__start = monotonic()
+        self.__last_tick = self.__start
+
+    #----------------------------------------------
+    # Register metrics, a name already registered returns the existing metric
+    def counter(self, name, help, labels = ()):
+        return self.__register(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels = ()):
+        return self.__register(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels, buckets):
+        return self.__register(Histogram, name, help, labels, buckets)
+
+    #----------------------------------------------
+    # Work out counter rates since the last tick
+    def tick(self):
+        with self.lock:
+            now = monotonic()
+            interval = now - self.__last_tick
+            if interval <= 0:
+                return
+            self.__last_tick = now
+            for metric in self.__metrics.values():
+                metric._tick(interval)
+
+    #----------------------------------------------
+    # Current values
+    def snapshot(self, prefix = ''):
+        """
+        Current values as plain types for the wire
+
+        Arguments:
+            prefix  --  only metrics whose name starts with prefix
+
+        Returns {'uptime' : seconds, 'metrics' : {name : {'type', 'help',
+        'series' : {label string : value}}}} where value is a number for
+        a gauge, {'total', 'rate'} for a counter and {'count', 'sum', 'p50',
+        'p95', 'p99'} for a histogram
+        """
+
+        result = {}
+        with self.lock:
+            for name, metric in self.__metrics.items():
+                if not name.startswith(prefix):
+                    continue
+                series = {}
+                for labels, s in metric._items():
+                    series[_labels(metric.labels, labels)] = metric._value(s)
+                result[name] = {'type' : metric.type, 'help' : metric.help, 'series' : series}
+        return {'uptime' : monotonic() - self.__start, 'metrics' : result}
+
+    #----------------------------------------------
+    # Prometheus text format
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            for name, metric in self.__metrics.items():
+                lines.append('# HELP %s %s' % (name, metric.help.replace('\\', '\\\\').replace('\n', '\\n')))
+                lines.append('# TYPE %s %s' % (name, metric.type))
+                for labels, s in metric._items():
+                    lines.extend(metric._lines(labels, s))
+        return '\n'.join(lines) + '\n'
+
+    #----------------------------------------------
+    # Write the Prometheus text to a file
+    # Written beside the file and renamed so a reader never sees half a file
+    def write(self, path):
+        temp = path + '.tmp'
+        with open(temp, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(temp, path)
+
+    #----------------------------------------------
+    # Add a metric
+    def __register(self, cls, name, help, labels, *args):
+        with self.lock:
+            metric = self.__metrics.get(name)
+            if metric == None:
+                metric = cls(self, name, help, labels, *args)
+                self.__metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError('Metric %s is already registered as a %s' % (name, metric.type))
+            return metric
+
+#----------------------------------------------
+# Label string {name="value",...}, empty if there are no labels
+def _labels(names, values):
+    if len(names) == 0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in zip(names, values))
+
+#----------------------------------------------
+# Number in Prometheus text format
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    elif value == float('-inf'):
+        return '-Inf'
+    return repr(value)
+
+#========================================================================
+# The registry used by the server
+registry = Registry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
@@ -25,18 +25,50 @@
 import os, sys
 import threading
 import socket
-import pickle
+import asyncio
+import time
 
 # Application imports
 from common.defs import *
+from common import wire
+import metrics
+
+# Datagrams received by request type, 'invalid' if they could not be decoded
+REQUESTS = metrics.counter('wsprlite_requests_total', 'UDP requests by type', ('type',))
 
 """
 Interface to the WSPRLite client application:
 
 Commands are UDP:
     
+Requests and responses use the binary protocol in common/wire.py. The
+request id and device id are echoed in the response. HELLO negotiates the largest
+datagram the client can receive and is answered here.
+
+Clients can subscribe to topics on one device or on ALL_DEVICES. Changes
+are pushed to subscribers with request id 0 until the lease runs out,
+subscribing again renews it.
+
+Datagrams are received on an asyncio event loop running in this thread.
+The callback must not block, device work is handed off and the response
+sent when it completes, so requests from several clients can be in flight
+at once. Each response is sent to the address of the client that made the
+request.
 """
 
+#========================================================================
+# Datagram protocol, passes everything to the net interface
+class NetProtocol(asyncio.DatagramProtocol):
+    
+    def __init__(self, receive):
+        self.__receive = receive
+        
+    def datagram_received(self, data, address):
+        self.__receive(data, address)
+        
+    def error_received(self, e):
+        print('Exception on socket %s' % (str(e)))
+
 #========================================================================
 # Net interface
 class NetIF(threading.Thread):
@@ -48,55 +80,173 @@ class NetIF(threading.Thread):
         Constructor
         
         Arguments:
-            callback    --  callback here when data arrives
+            callback    --  callback here when a request arrives as callback(request, address, rid, device)
             
         """
 
         super(NetIF, self).__init__()
         self.__callback = callback
         
-        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.__sock.bind((RQST_IP, RQST_PORT))
-        self.__sock.settimeout(3)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((RQST_IP, RQST_PORT))
+        
+        # Create the endpoint now so any error is raised to the caller
+        self.__loop = asyncio.new_event_loop()
+        self.__transport, protocol = self.__loop.run_until_complete(
+            self.__loop.create_datagram_endpoint(lambda: NetProtocol(self.__receive), sock=sock))
         
-        self.__address = None
-        self.__terminate = False
+        # Clients seen, address : [time last request, number of requests, datagram size]
+        self.__clients = {}
+        # Subscriptions, (address, device) : [lease expiry, set of topics]
+        self.__subscribers = {}
     
     #----------------------------------------------
     # Terminate
     def terminate(self):
         """ Terminate thread """
         
-        self.__terminate = True
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
     
     #----------------------------------------------
     # Do response
-    def response(self, data):
+    def response(self, data, address, rid = 0, device = 0):
         """
-        Send response data
+        Send response data, may be called from any thread
         
         Arguments:
-            data    --  bytestream to send
+            data    --  response to send
+            address --  client address
+            rid     --  request id of the request, 0 if unsolicited
+            device  --  device the response is from
         
         """
         
-        if self.__address != None:
+        try:
             try:
-                pickledData = pickle.dumps(data)
-                self.__sock.sendto(pickledData, self.__address)
-                
-            except Exception as e:
-                print('Exception on socket send %s' % (str(e)))
+                encoded = wire.encode(rid, data, device)
+            except wire.WireError as e:
+                # Tell the client rather than leave the request to time out
+                encoded = wire.encode(rid, (data[0], (False, 'Response cannot be encoded [%s]' % str(e))), device)
+            client = self.__clients.get(address)
+            size = WIRE_MIN_DATAGRAM if client == None else client[2]
+            if len(encoded) > size:
+                encoded = wire.encode(rid, (data[0], (False, 'Response too large for datagram size %d!' % size)), device)
+            self.__loop.call_soon_threadsafe(self.__send, encoded, address)
+        except Exception as e:
+            print('Exception on socket send %s' % (str(e)))
+    
+    #----------------------------------------------
+    # Send to all clients
+    def broadcast(self, data, device = 0):
+        """
+        Send data to every client heard from within CLIENT_TIMEOUT
+        
+        Arguments:
+            data    --  data to send
+            device  --  device the data is from
+        
+        """
+        
+        for address in self.clients():
+            self.response(data, address, 0, device)
+    
+    #----------------------------------------------
+    # Subscribe a client, called on the event loop
+    def subscribe(self, address, topics, device = 0, lease = SUBSCRIBE_LEASE):
+        """
+        Add or renew a subscription, replacing the topics
+        
+        Arguments:
+            address --  client address
+            topics  --  topics to push to the client
+            device  --  device to watch or ALL_DEVICES
+            lease   --  seconds before the subscription expires
+        
+        """
+        
+        self.__subscribers[(address, device)] = [time.time() + lease, set(topics)]
+    
+    #----------------------------------------------
+    # Unsubscribe a client, called on the event loop
+    def unsubscribe(self, address, device = 0):
+        return self.__subscribers.pop((address, device), None) != None
+    
+    #----------------------------------------------
+    # Send to subscribers
+    def publish(self, topic, data, device = 0):
+        """
+        Send data to every client subscribed to topic, may be called from any thread
+        
+        Arguments:
+            topic   --  topic that changed
+            data    --  data to send
+            device  --  device the change is on
+        
+        """
+        
+        self.__loop.call_soon_threadsafe(self.__publish, topic, data, device)
+    
+    #----------------------------------------------
+    # Active clients
+    def clients(self):
+        """ Return the addresses of clients heard from within CLIENT_TIMEOUT """
+        
+        now = time.time()
+        return [address for address, client in list(self.__clients.items()) if now - client[0] < CLIENT_TIMEOUT]
     
     #----------------------------------------------
     # Entry point            
     def run(self):
         """ Listen for requests """
         
-        while not self.__terminate:
-            try:
-                data, self.__address = self.__sock.recvfrom(100)
-                self.__callback(data)
-            except socket.timeout:
-                continue
-            
\ No newline at end of file
+        asyncio.set_event_loop(self.__loop)
+        self.__loop.run_forever()
+        self.__transport.close()
+        self.__loop.close()
+    
+    #----------------------------------------------
+    # Datagram from a client, called on the event loop
+    def __receive(self, data, address):
+        client = self.__clients.get(address)
+        if client == None:
+            client = [time.time(), 1, WIRE_MIN_DATAGRAM]
+            self.__clients[address] = client
+        else:
+            client[0] = time.time()
+            client[1] += 1
+        try:
+            rid, device, request = wire.decode(data)
+        except wire.WireError as e:
+            REQUESTS.inc('invalid')
+            self.response((UNKNOWN, (False, 'Failed to decode request [%s]' % str(e))), address)
+            return
+        REQUESTS.inc(request[0])
+        if request[0] == HELLO:
+            # Datagram size negotiation
+            if len(request) == 2 and isinstance(request[1], int):
+                client[2] = max(WIRE_MIN_DATAGRAM, min(request[1], WIRE_MAX_DATAGRAM))
+            self.response((HELLO, (True, client[2])), address, rid, device)
+            return
+        try:
+            self.__callback(request, address, rid, device)
+        except Exception as e:
+            print('Exception processing request %s' % (str(e)))
+            self.response((request[0], (False, 'Invalid request [%s]' % str(e))), address, rid, device)
+    
+    #----------------------------------------------
+    # Send to subscribers on the event loop, dropping expired leases
+    def __publish(self, topic, data, device):
+        now = time.time()
+        for key, subscription in list(self.__subscribers.items()):
+            if subscription[0] < now:
+                del self.__subscribers[key]
+            elif topic in subscription[1] and key[1] in (device, ALL_DEVICES):
+                self.response(data, key[0], 0, device)
+    
+    #----------------------------------------------
+    # Send on the event loop
+    def __send(self, data, address):
+        try:
+            self.__transport.sendto(data, address)
+        except Exception as e:
+            print('Exception on socket send %s' % (str(e)))
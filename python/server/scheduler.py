@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+#
+# scheduler.py
+#
+# Copyright (C) 2019 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    Event scheduler for planned TX campaigns.
+
+    Events are held in a heap ordered by UTC time so a whole day of slots
+    can be loaded at once. Scheduling an event is O(log n). Cancelling marks
+    the event and it is discarded when it reaches the top of the heap. The
+    heap is rebuilt if cancelled events come to outnumber live ones.
+
+    The thread sleeps until the earliest event is due and makes the callback
+    on the scheduler thread, so callbacks should hand off any slow work.
+"""
+
+# Python imports
+import os, sys
+import threading
+import heapq
+import itertools
+import time
+
+# Application imports
+sys.path.append('..')
+from common.defs import *
+
+# Entry fields, entries are lists so they can be marked cancelled in place
+WHEN = 0
+SEQ = 1
+CALLBACK = 2
+ARGS = 3
+CANCELLED = 4
+
+#========================================================================
+"""
+    Heap based event scheduler
+"""
+class Scheduler(threading.Thread):
+
+    #----------------------------------------------
+    # Constructor
+    def __init__(self):
+        """
+        Constructor
+
+        """
+
+        super(Scheduler, self).__init__()
+
+        self.__terminate = False
+
+        self.__heap = []
+        # Event id : entry, for cancellation
+        self.__entries = {}
+        self.__cancelled = 0
+        self.__seq = itertools.count(1)
+        self.__cond = threading.Condition()
+
+    #----------------------------------------------
+    # Terminate
+    def terminate(self):
+        """
+            Terminate thread
+        """
+        with self.__cond:
+            self.__terminate = True
+            self.__cond.notify()
+
+    #----------------------------------------------
+    # Add an event
+    def schedule(self, when, callback, *args):
+        """
+        Schedule a callback
+
+        Arguments:
+            when        --  UTC epoch seconds
+            callback    --  callable to call at when
+            args        --  arguments for callback
+
+        Returns an event id for cancel()
+        """
+
+        with self.__cond:
+            seq = next(self.__seq)
+            entry = [when, seq, callback, args, False]
+            self.__entries[seq] = entry
+            heapq.heappush(self.__heap, entry)
+            if self.__heap[0] is entry:
+                # New earliest event, recalculate the sleep
+                self.__cond.notify()
+            return seq
+
+    #----------------------------------------------
+    # Remove an event
+    def cancel(self, event_id):
+        """
+        Cancel an event
+
+        Arguments:
+            event_id    --  as returned by schedule()
+
+        Returns True if the event was pending
+        """
+
+        with self.__cond:
+            entry = self.__entries.pop(event_id, None)
+            if entry == None:
+                return False
+            entry[CANCELLED] = True
+            self.__cancelled += 1
+            if self.__cancelled > len(self.__entries):
+                self.__compact()
+            return True
+
+    #----------------------------------------------
+    # Remove all events
+    def cancel_all(self):
+        with self.__cond:
+            self.__heap = []
+            self.__entries = {}
+            self.__cancelled = 0
+
+    #----------------------------------------------
+    # Number of pending events
+    def pending(self):
+        return len(self.__entries)
+
+    #----------------------------------------------
+    # Time of the next event
+    def next_event(self):
+        """
+            Returns UTC epoch seconds of the next event or None
+        """
+        with self.__cond:
+            self.__discard_cancelled()
+            if len(self.__heap) == 0:
+                return None
+            return self.__heap[0][WHEN]
+
+    #----------------------------------------------
+    # Entry point
+    def run(self):
+        """
+            Dispatch events when due
+        """
+        while True:
+            with self.__cond:
+                while True:
+                    if self.__terminate:
+                        return
+                    self.__discard_cancelled()
+                    if len(self.__heap) == 0:
+                        self.__cond.wait()
+                        continue
+                    remaining = self.__heap[0][WHEN] - time.time()
+                    if remaining <= 0:
+                        entry = heapq.heappop(self.__heap)
+                        del self.__entries[entry[SEQ]]
+                        break
+                    # Condition waits on the monotonic clock
+                    self.__cond.wait(remaining)
+            # Call outside the lock so the callback can schedule more events
+            try:
+                entry[CALLBACK](*entry[ARGS])
+            except Exception as e:
+                print('Exception in scheduled event [%s]' % str(e))
+
+    #----------------------------------------------
+    # Pop cancelled entries off the top of the heap, lock held
+    def __discard_cancelled(self):
+        while len(self.__heap) > 0 and self.__heap[0][CANCELLED]:
+            heapq.heappop(self.__heap)
+            self.__cancelled -= 1
+
+    #----------------------------------------------
+    # Rebuild the heap without cancelled entries, lock held
+    def __compact(self):
+        self.__heap = [entry for entry in self.__heap if not entry[CANCELLED]]
+        heapq.heapify(self.__heap)
+        self.__cancelled = 0
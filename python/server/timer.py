@@ -29,18 +29,56 @@
     
     The timing is done in a separate thread and a callback is made when the
     start/stop time has been reached.
+    
+    The thread computes the UTC deadline and sleeps until it on the monotonic
+    clock so it uses no CPU while waiting. A cancel wakes it immediately.
+    The difference between the deadline and the actual wake-up time is
+    recorded as jitter.
 """
 
 # Python imports
 import os, sys
 import threading
-import datetime
 import queue
+import time
 from time import sleep
 
 # Application imports
 sys.path.append('..')
 from common.defs import *
+import metrics
+
+# Wake-up jitter buckets, seconds
+JITTER_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1)
+JITTER = metrics.histogram('wsprlite_timer_jitter_seconds', 'Seconds the timer woke after its deadline', (), JITTER_BUCKETS)
+
+# WSPR cycle is two minutes from an even UTC minute
+CYCLE = 120
+# Transmission starts 1s into the cycle
+START_OFFSET = 1
+# Stop window opens 5s before the next cycle, 110.6s TX is complete by then
+STOP_OFFSET = 115
+# Transmission ends at 111.6s, the gap to the next start is used for band changes
+GAP_OFFSET = 112
+
+#----------------------------------------------
+# UTC epoch seconds of the next transmission start at or after t
+def next_start(t):
+    start = (t // CYCLE) * CYCLE + START_OFFSET
+    if start < t:
+        start += CYCLE
+    return start
+
+#----------------------------------------------
+# UTC epoch seconds of the transmission start in the cycle containing t
+def slot_start(t):
+    return (t // CYCLE) * CYCLE + START_OFFSET
+
+#----------------------------------------------
+# UTC epoch seconds of the next stop window at or after t
+# If the stop window is already open this is t
+def next_stop(t):
+    return max(t, (t // CYCLE) * CYCLE + STOP_OFFSET)
 
 #========================================================================
 """
@@ -65,10 +103,14 @@ class TimerThrd (threading.Thread):
         self.__stop_callback = stop_callback
         
         self.__terminate = False
-        self.__cancel = False
+        # Set to abandon the current wait
+        self.__cancel = threading.Event()
         
         # Create a queue for communication with the thread
         self.__q = queue.Queue(5)
+        
+        # Wake-up jitter in seconds, actual - deadline
+        self.__jitter = {'count' : 0, 'last' : 0.0, 'max' : 0.0, 'total' : 0.0}
     
     #----------------------------------------------
     # Terminate
@@ -77,21 +119,36 @@ class TimerThrd (threading.Thread):
             Terminate thread
         """
         self.__terminate = True
+        self.__cancel.set()
     
     #----------------------------------------------
     # Called prior to executing a start TX 
     def wait_start(self):
+        self.__cancel.clear()
         self.__q.put(WAIT_START)
     
     #----------------------------------------------
     # Called prior to executing a start TX 
     def wait_stop(self):
+        self.__cancel.clear()
         self.__q.put(WAIT_STOP)
 
     #----------------------------------------------
     # Called to cancel timer
     def cancel(self):
-        self.__cancel = True
+        self.__cancel.set()
+    
+    #----------------------------------------------
+    # Wake-up jitter statistics
+    def get_jitter(self):
+        """
+            Returns (count, last, mean, max) jitter in seconds
+        """
+        j = self.__jitter
+        mean = 0.0
+        if j['count'] > 0:
+            mean = j['total']/j['count']
+        return (j['count'], j['last'], mean, j['max'])
         
     #----------------------------------------------
     # Entry point   
@@ -102,55 +159,50 @@ class TimerThrd (threading.Thread):
         while not self.__terminate:
             try:
                 rqst = self.__q.get(timeout=1)
-                if rqst == WAIT_START:
-                    self.__start_time()
-                    if not self.__cancel:
-                        self.__start_callback()
-                    self.__cancel = False
-                elif rqst == WAIT_STOP:
-                    self.__stop_time()
-                    if not self.__cancel:
-                        self.__stop_callback()
-                    self.__cancel = False
-                elif rqst == CANCEL:
-                    self.__cancel = True
-            except:
+            except queue.Empty:
                 continue
-            
-    #----------------------------------------------
-    # Start time   
-    def __start_time(self):
-        """
-            Wait for start time
-        """
-        while not self.__terminate and not self.__cancel:
-            dt = datetime.datetime.utcnow()
-            if dt.second == 0:
-                if dt.minute%2 == 0:
-                    # We just crossed an even minute
-                    # Wait for the next tick
-                    while not self.__terminate:
-                        dt = datetime.datetime.utcnow()
-                        if dt.second == 1:
-                            break
-                    return
-            sleep(0.05)
+            if rqst == WAIT_START:
+                if self.__wait_until(next_start(time.time())):
+                    self.__start_callback()
+            elif rqst == WAIT_STOP:
+                if self.__wait_until(next_stop(time.time())):
+                    self.__stop_callback()
+            elif rqst == CANCEL:
+                self.__cancel.set()
     
     #----------------------------------------------
-    # Stop time   
-    def __stop_time(self):
+    # Sleep until a deadline
+    def __wait_until(self, deadline):
         """
-            Wait to enter stop window
+            Wait for the UTC deadline
+            
+            Arguments
+                deadline    --  UTC epoch seconds
+            
+            Returns True if the deadline was reached, False if cancelled
         """
         
-        while not self.__terminate and not self.__cancel:
-            dt = datetime.datetime.utcnow()
-            if dt.second >= 55:
-                if dt.minute%2 != 0:
-                    # We are at least 110.6s from the start time
-                    # Any transmission should be finished
-                    break                        
-            sleep(1.0)
+        # Convert to the monotonic clock so the wait is not disturbed by
+        # clock adjustments
+        target = time.monotonic() + (deadline - time.time())
+        while True:
+            remaining = target - time.monotonic()
+            if remaining <= 0:
+                break
+            if self.__cancel.wait(remaining):
+                return False
+        self.__record_jitter(time.time() - deadline)
+        return True
+    
+    #----------------------------------------------
+    # Update jitter statistics
+    def __record_jitter(self, jitter):
+        j = self.__jitter
+        j['count'] += 1
+        j['last'] = jitter
+        j['total'] += jitter
+        j['max'] = max(j['max'], jitter)
+        JITTER.observe(jitter)
             
 #========================================================================
 # Module Test
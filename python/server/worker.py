@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+#
+# worker.py
+#
+# Copyright (C) 2019 by G3UKB Bob Cowdery
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  The author can be reached by email at:
+#     bob@bobcowdery.plus.com
+#
+
+"""
+    The WSPRLite must only be sent one message at a time and the response
+    read before the next message is sent. Requests arrive from the net
+    interface thread and the timer thread so all serial exchanges are
+    executed by this single worker thread which owns the port.
+
+    Work is posted as a callable and the caller is given a Future which
+    completes with the result of the callable. Time critical work (TX start
+    and stop) is given priority over queued requests, otherwise work is
+    executed in the order it was submitted.
+"""
+
+# Python imports
+import os, sys
+import threading
+import queue
+import itertools
+from concurrent.futures import Future
+
+# Work priorities, lower runs first
+PRIORITY_TX = 0
+PRIORITY_NORMAL = 1
+
+#========================================================================
+"""
+    Serial worker thread
+"""
+class SerialWorker(threading.Thread):
+
+    #----------------------------------------------
+    # Constructor
+    def __init__(self):
+        """
+        Constructor
+
+        """
+
+        super(SerialWorker, self).__init__()
+
+        self.__terminate = False
+
+        # Work queue ordered by priority then submission order
+        self.__q = queue.PriorityQueue()
+        self.__seq = itertools.count()
+
+    #----------------------------------------------
+    # Terminate
+    def terminate(self):
+        """
+            Terminate thread
+        """
+        self.__terminate = True
+
+    #----------------------------------------------
+    # Submit work
+    def submit(self, fn, *args, priority=PRIORITY_NORMAL):
+        """
+        Queue work for the serial thread
+
+        Arguments:
+            fn          --  callable to execute on the serial thread
+            args        --  arguments for fn
+            priority    --  PRIORITY_TX or PRIORITY_NORMAL
+
+        Returns a Future for the result of fn
+        """
+
+        future = Future()
+        self.__q.put((priority, next(self.__seq), future, fn, args))
+        return future
+
+    #----------------------------------------------
+    # Entry point
+    def run(self):
+        """
+            Execute work in order
+        """
+        while not self.__terminate:
+            try:
+                priority, seq, future, fn, args = self.__q.get(timeout=1)
+            except queue.Empty:
+                continue
+            if not future.set_running_or_notify_cancel():
+                # Caller cancelled before we got to it
+                continue
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        # Anything left will never run
+        while not self.__q.empty():
+            priority, seq, future, fn, args = self.__q.get()
+            future.cancel()